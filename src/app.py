@@ -1,12 +1,18 @@
-import os 
+import time
 
-import gradio as gr
+# measure the cold start from before the heavy imports
+STARTED_AT = time.perf_counter()
 
-from langchain_core.messages import AIMessage, HumanMessage
-from langchain_openai import ChatOpenAI
-from dotenv import load_dotenv
+import json  # noqa: E402
+import logging  # noqa: E402
+import os  # noqa: E402
 
-from graph import AssistantGraph
+import gradio as gr  # noqa: E402
+
+from dotenv import load_dotenv  # noqa: E402
+
+from application import Application  # noqa: E402
+from metrics import start_metrics_server  # noqa: E402
 
 
 # load the environment variables
@@ -15,29 +21,53 @@ load_dotenv()
 VECTOR_DB_PATH = "data/chroma_db"
 SOURCE_DATA_PATH = "data/source.md"
 
-# define llm
-llm = ChatOpenAI(model=os.getenv("OPENAI_MODEL"), temperature=0)
-
-# create instance of assistant graph
-app = AssistantGraph(llm=llm, vector_db_path=VECTOR_DB_PATH, source_data_path=SOURCE_DATA_PATH)
-
-def process_history(history):
-    """Return the history as a list of HumanMessage and AIMessage tuples"""
-    chat_history = []
-    for pair in history:
-        human_message, ai_message = pair
-        chat_history.append(HumanMessage(content=human_message))
-        chat_history.append(AIMessage(content=ai_message))
-    return chat_history
+# the components are built on first use, or by the warmup before the server starts
+application = Application(
+    vector_db_path=VECTOR_DB_PATH,
+    source_data_path=SOURCE_DATA_PATH,
+    # route each stage to its model: classification on OPENAI_FUNCTIONS_MODEL, generation on OPENAI_MODEL. MODEL_ROUTES
+    # overrides the settings per stage as a JSON object, e.g. {"rag": {"max_tokens": 800, "timeout": 30}}
+    model_routes=json.loads(os.getenv("MODEL_ROUTES", "{}")),
+    graph_options={
+        "retriever_backend": os.getenv("RETRIEVER_BACKEND", "chroma"),
+        "hybrid_retrieval": os.getenv("HYBRID_RETRIEVAL", "false").lower() == "true",
+        # answer questions similar to previously answered ones from a cache, once the threshold is calibrated
+        "use_semantic_cache": os.getenv("SEMANTIC_CACHE", "false").lower() == "true",
+        "semantic_cache_threshold": float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.95)),
+        # decide confidently classified intents locally before calling the LLM, once the thresholds are calibrated
+        "use_intent_router": os.getenv("INTENT_ROUTER", "false").lower() == "true",
+        "intent_min_similarity": float(os.getenv("INTENT_MIN_SIMILARITY", 0.85)),
+        "intent_min_margin": float(os.getenv("INTENT_MIN_MARGIN", 0.05)),
+        # bound the tail latency of a turn, falling back to cheaper routes as its deadline nears
+        "time_budget": float(os.getenv("REQUEST_TIME_BUDGET")) if os.getenv("REQUEST_TIME_BUDGET") else None,
+        "node_timeout": float(os.getenv("NODE_TIMEOUT")) if os.getenv("NODE_TIMEOUT") else None,
+    },
+    history_max_turns=int(os.getenv("HISTORY_MAX_TURNS", 4)),
+    history_token_budget=int(os.getenv("HISTORY_TOKEN_BUDGET", 1500)),
+    max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", 100)),
+    max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20)),
+    keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 120)),
+    # coalesce the query embeddings of concurrent conversations, 0 disables it
+    embedding_batch_window=float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", 5)) / 1000 or None,
+    started_at=STARTED_AT,
+)
 
-def run(message, history):
-    chat_history = process_history(history[1:]) # ignore the auto message
-    inputs = {"keys": {"message": message, "history": chat_history}}
-    result = app.run(inputs)
-    response = result["keys"]["response"]
-    return response
+run = application.run
 
 initial_message = "Hi there! I'm Saj, an AI assistant built by Sajal Sharma. I'm here to answer any questions you may have about Sajal. Ask me anything!"
 
 if __name__ == "__main__":
-    gr.ChatInterface(run, chatbot=gr.Chatbot(value=[[None, initial_message]])).launch(server_name="0.0.0.0", server_port=7860, share=False)
\ No newline at end of file
+    # log one structured line per turn, and serve the metrics in the Prometheus text format if a port is set
+    logging.basicConfig(level=logging.INFO)
+    if os.getenv("METRICS_PORT"):
+        start_metrics_server(int(os.getenv("METRICS_PORT")))
+    warmup = os.getenv("WARMUP", "true").lower() == "true"
+    if warmup:
+        application.warmup()
+    # the handler is async, so let the event loop serve all in-flight conversations instead of queueing them
+    demo = gr.ChatInterface(run, chatbot=gr.Chatbot(value=[[None, initial_message]]), concurrency_limit=None)
+    if warmup:
+        # async connections belong to the event loop that opened them, so open them from the server's loop
+        with demo:
+            demo.load(application.awarmup)
+    demo.launch(server_name="0.0.0.0", server_port=7860, share=False)
@@ -0,0 +1,194 @@
+"""Implements the Application class, the factory building the assistant's components on first use"""
+
+import asyncio
+import logging
+import threading
+import time
+from functools import cached_property
+
+import httpx
+import openai
+from langchain_openai import OpenAIEmbeddings
+
+from chains.summarize_history import SummarizeHistory
+from context_packing import get_encoding
+from embedding_batcher import BatchingEmbeddings
+from graph import AssistantGraph
+from memory import ConversationMemory
+from metrics import record_startup
+from model_routing import ModelRouter
+
+logger = logging.getLogger(__name__)
+
+WARMUP_QUERY = "Where does Sajal work?"
+
+
+class Application:
+    """
+    Builds the OpenAI clients, the assistant graph and the conversation memory lazily, on first use.
+
+    Every chat and embedding model sends its requests through one keep-alive connection pool per I/O model: a sync
+    httpx client, used by the sync path and the Chroma store's embedding calls, and an async one used by the async
+    path. warmup builds everything and loads the indexes before the server starts. awarmup opens connections in the
+    async pool, and has to run in the serving event loop because async connections belong to the loop that opened them.
+    """
+
+    def __init__(
+        self,
+        vector_db_path,
+        source_data_path,
+        model_routes=None,
+        graph_options=None,
+        history_max_turns=4,
+        history_token_budget=1500,
+        max_connections=100,
+        max_keepalive_connections=20,
+        keepalive_expiry=120.0,
+        connect_timeout=5.0,
+        warmup_connections=4,
+        embedding_batch_window=0.005,
+        embedding_max_batch_size=64,
+        started_at=None,
+    ):
+        """
+        Args:
+            vector_db_path (str): The persist directory of the vector store
+            source_data_path (str): The path to the full source data
+            model_routes (dict): Settings per stage for the ModelRouter
+            graph_options (dict): Further AssistantGraph arguments
+            history_max_turns (int): Number of most recent turns kept verbatim in the history
+            history_token_budget (int): Maximum number of tokens of the history
+            max_connections (int): Maximum number of connections of each pool
+            max_keepalive_connections (int): Maximum number of idle connections kept open in each pool
+            keepalive_expiry (float): Seconds an idle connection is kept open
+            connect_timeout (float): Timeout in seconds for opening a connection
+            warmup_connections (int): Number of connections awarmup opens in the async pool
+            embedding_batch_window (float): Seconds concurrent query embeddings are collected for before they are sent
+                in one call, None to embed each query in a call of its own
+            embedding_max_batch_size (int): Maximum number of query embeddings sent in one call
+            started_at (float): time.perf_counter() at process start, the cold start is measured from, defaults to now
+        """
+        self.started_at = time.perf_counter() if started_at is None else started_at
+        self.vector_db_path = vector_db_path
+        self.source_data_path = source_data_path
+        self.model_routes = model_routes
+        self.graph_options = graph_options or {}
+        self.history_max_turns = history_max_turns
+        self.history_token_budget = history_token_budget
+        self.warmup_connections = warmup_connections
+        self.embedding_batch_window = embedding_batch_window
+        self.embedding_max_batch_size = embedding_max_batch_size
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        # the OpenAI clients set the read timeout of each request themselves
+        self._timeout = httpx.Timeout(600.0, connect=connect_timeout)
+        self._awarmed_up = False
+        self._first_request_lock = threading.Lock()
+        self._first_request_done = False
+
+    @cached_property
+    def openai_client(self):
+        return openai.OpenAI(http_client=httpx.Client(limits=self._limits, timeout=self._timeout))
+
+    @cached_property
+    def async_openai_client(self):
+        return openai.AsyncOpenAI(http_client=httpx.AsyncClient(limits=self._limits, timeout=self._timeout))
+
+    @cached_property
+    def model_router(self):
+        return ModelRouter(routes=self.model_routes, client=self.openai_client, async_client=self.async_openai_client)
+
+    @cached_property
+    def embedding_model(self):
+        embedding_model = OpenAIEmbeddings(
+            client=self.openai_client.embeddings, async_client=self.async_openai_client.embeddings
+        )
+        if self.embedding_batch_window is None:
+            return embedding_model
+        # the retriever caches in front of the batcher, so only uncached queries are batched
+        return BatchingEmbeddings(
+            embedding_model, max_wait=self.embedding_batch_window, max_batch_size=self.embedding_max_batch_size
+        )
+
+    @cached_property
+    def graph(self):
+        return AssistantGraph(
+            llm=self.model_router,
+            vector_db_path=self.vector_db_path,
+            source_data_path=self.source_data_path,
+            embedding_model=self.embedding_model,
+            **self.graph_options,
+        )
+
+    @cached_property
+    def memory(self):
+        # bound the history sent to the chains, older turns are folded into a rolling summary
+        return ConversationMemory(
+            summarizer=SummarizeHistory(self.model_router.llm("summarize")),
+            max_turns=self.history_max_turns,
+            token_budget=self.history_token_budget,
+            model=self.model_router.routes["rag"]["model"],
+        )
+
+    def warmup(self):
+        """
+        Builds every component, loads the token encodings and runs a retrieval, so the first turn does not pay for them
+
+        The retrieval loads the vector index and opens a connection in the sync pool. Warmup is best effort: a failed
+        step is logged and the remaining steps still run.
+        """
+        start = time.perf_counter()
+        # building the graph loads the vector store, reads the source data and compiles the prompts and the graph
+        self.graph
+        self.memory
+        record_startup("build", time.perf_counter() - start)
+        steps = [
+            ("encodings", lambda: [get_encoding(route["model"]) for route in self.model_router.routes.values()]),
+            ("retrieval", lambda: self.graph.retriever.run(query=WARMUP_QUERY)),
+        ]
+        for name, step in steps:
+            try:
+                step()
+            except Exception:
+                logger.warning("warmup step %s failed", name, exc_info=True)
+        record_startup("warmup", time.perf_counter() - start)
+        record_startup("ready", time.perf_counter() - self.started_at)
+
+    async def awarmup(self):
+        """Opens warmup_connections connections in the async pool, once per process"""
+        if self._awarmed_up:
+            return
+        self._awarmed_up = True
+        start = time.perf_counter()
+        # concurrent requests each take a connection of their own, which stays in the pool once they complete
+        results = await asyncio.gather(
+            *(self.async_openai_client.models.list() for _ in range(self.warmup_connections)), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning("warmup connection failed: %r", result)
+        record_startup("connections", time.perf_counter() - start)
+
+    def _record_first_request(self, seconds):
+        with self._first_request_lock:
+            if self._first_request_done:
+                return
+            self._first_request_done = True
+        record_startup("first_request", seconds)
+
+    async def run(self, message, history):
+        """The chat handler, yields the response as it is streamed"""
+        start = time.perf_counter()
+        turns = history[1:] # ignore the auto message
+        chat_history = await self.memory.aview(turns)
+        inputs = {"keys": {"message": message, "history": chat_history}}
+        response = ""
+        async for token in self.graph.astream(inputs):
+            response += token
+            yield response
+        self._record_first_request(time.perf_counter() - start)
+        # summarize in the background what the next turn will need
+        self.memory.prefetch(turns + [(message, response)])
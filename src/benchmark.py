@@ -0,0 +1,198 @@
+"""Script to benchmark the assistant graph offline, against deterministic stand-ins for the OpenAI models"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+from embedding_batcher import BatchingEmbeddings
+from fake_models import FakeChatModel, FakeEmbeddings
+from graph import AssistantGraph
+from ingest_data import ingest
+from memory import process_history
+from metrics import finish_request, start_request
+
+SOURCE_DATA_PATH = "data/source.md"
+
+# scripted multi-turn sessions, one per graph route
+SESSIONS = {
+    "chat": ["hi there", "how are you today?", "thanks, bye"],
+    "rag": ["where does sajal work?", "what is his experience with machine learning?", "how can I contact him?"],
+    "generate_answer_using_all_data": ["what is his favourite colour?", "does he have a zebra?"],
+}
+
+
+def percentile(values, q):
+    """Returns the q-th percentile of the values, by nearest rank"""
+    values = sorted(values)
+    return values[min(int(round(q / 100 * (len(values) - 1))), len(values) - 1)]
+
+
+def summarize(turns):
+    latencies = [turn["duration_seconds"] for turn in turns]
+    return {
+        "turns": len(turns),
+        "p50_seconds": round(percentile(latencies, 50), 4),
+        "p95_seconds": round(percentile(latencies, 95), 4),
+        "p99_seconds": round(percentile(latencies, 99), 4),
+        "llm_calls_per_turn": round(statistics.mean(turn["llm_calls"] for turn in turns), 3),
+        "degraded_turns": sum(1 for turn in turns if turn["degradations"]),
+    }
+
+
+def summarize_run(records, elapsed):
+    """Returns the summary of a run's turn records overall, with its throughput, and per route"""
+    routes = {}
+    for record in records:
+        routes.setdefault(record["route"] or "unknown", []).append(record)
+    return {
+        "overall": {**summarize(records), "throughput_turns_per_second": round(len(records) / elapsed, 3)},
+        "routes": {route: summarize(route_records) for route, route_records in sorted(routes.items())},
+    }
+
+
+async def run_session(graph, script, semaphore):
+    """Runs the turns of one session in order, returning the metrics record of each turn"""
+    records, history = [], []
+    async with semaphore:
+        for message in script:
+            request_metrics = start_request()
+            result = await graph.arun({"keys": {"message": message, "history": process_history(history)}})
+            records.append(finish_request(request_metrics))
+            history.append((message, result["keys"]["response"]))
+    return records
+
+
+async def run_sessions(graph, repeats, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    sessions = [script for _ in range(repeats) for script in SESSIONS.values()]
+    results = await asyncio.gather(*(run_session(graph, script, semaphore) for script in sessions))
+    return [record for records in results for record in records]
+
+
+def benchmark(
+    repeats=10,
+    concurrency=4,
+    llm_latency=0.2,
+    tokens_per_second=50.0,
+    embedding_latency=0.05,
+    embedding_batch_window=None,
+    source_data_path=SOURCE_DATA_PATH,
+    graph_options=None,
+):
+    """
+    Drives the scripted sessions through the graph against the stand-in models
+
+    Args:
+        repeats (int): Number of times each scripted session is run
+        concurrency (int): Number of sessions in flight at once
+        llm_latency (float): Seconds before the first token of every chat model call
+        tokens_per_second (float): Generation speed of the stand-in chat model's answers
+        embedding_latency (float): Seconds per embedding call
+        embedding_batch_window (float): Seconds query embeddings are collected for into one call, None to not batch
+        source_data_path (str): The source data to ingest into a temporary vector store
+        graph_options (dict): Further AssistantGraph arguments, to compare configurations
+
+    Returns:
+        dict: The configuration, and the latency percentiles, throughput and LLM calls per turn overall and per route of
+            the cold run, a fresh graph per repeat, and of the warm run, one graph with primed caches over every repeat
+    """
+    llm = FakeChatModel(latency=llm_latency, tokens_per_second=tokens_per_second)
+    embeddings = FakeEmbeddings(latency=embedding_latency)
+    data_dir = tempfile.mkdtemp(prefix="assistant-benchmark-")
+    try:
+        # ingest into a scratch data directory, so the benchmark never touches the real index
+        source_path = shutil.copy(source_data_path, os.path.join(data_dir, "source.md"))
+        vector_db_path = os.path.join(data_dir, "chroma_db")
+        ingest(
+            source_path=source_path,
+            vector_db_path=vector_db_path,
+            manifest_path=os.path.join(data_dir, "manifest.json"),
+            vector_index_path=os.path.join(data_dir, "vector_index"),
+            bm25_index_path=os.path.join(data_dir, "bm25_index.json"),
+            sections_path=os.path.join(data_dir, "sections.json"),
+            embeddings_model=embeddings,
+        )
+        # the answer and grade caches are off unless asked for, so repeats of a session are graded and answered again
+        options = {"use_semantic_cache": False, "use_grade_cache": False, **(graph_options or {})}
+        query_embeddings = embeddings
+        if embedding_batch_window is not None:
+            query_embeddings = BatchingEmbeddings(embeddings, max_wait=embedding_batch_window)
+
+        def build_graph(name):
+            # caches of their own, in a directory of their own, so a graph starts with every cache cold
+            cache_dir = os.path.join(data_dir, name)
+            os.makedirs(cache_dir)
+            graph_kwargs = {"grade_cache_path": os.path.join(cache_dir, "grade_cache.sqlite3"), **options}
+            graph_kwargs["retriever_options"] = {
+                "embedding_cache_path": os.path.join(cache_dir, "embedding_cache.sqlite3"),
+                **options.get("retriever_options", {}),
+            }
+            return AssistantGraph(
+                llm=llm,
+                vector_db_path=vector_db_path,
+                source_data_path=source_path,
+                embedding_model=query_embeddings,
+                grader_llm=llm,
+                **graph_kwargs,
+            )
+
+        # cold: a fresh graph per repeat, so no repeat reuses the query embeddings, intent centroids or verdicts of
+        # another one
+        cold_records, cold_elapsed = [], 0.0
+        for repeat in range(repeats):
+            graph = build_graph(f"cold-{repeat}")
+            start = time.perf_counter()
+            cold_records += asyncio.run(run_sessions(graph, 1, concurrency))
+            cold_elapsed += time.perf_counter() - start
+        # warm: one graph over every repeat, after a pass priming its caches, as a long running server sees it
+        graph = build_graph("warm")
+        asyncio.run(run_sessions(graph, 1, concurrency))
+        start = time.perf_counter()
+        warm_records = asyncio.run(run_sessions(graph, repeats, concurrency))
+        warm_elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    return {
+        "config": {
+            "repeats": repeats,
+            "concurrency": concurrency,
+            "llm_latency": llm_latency,
+            "tokens_per_second": tokens_per_second,
+            "embedding_latency": embedding_latency,
+            "embedding_batch_window": embedding_batch_window,
+            "graph_options": options,
+        },
+        "cold": summarize_run(cold_records, cold_elapsed),
+        "warm": summarize_run(warm_records, warm_elapsed),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeats", type=int, default=10, help="number of times each scripted session is run")
+    parser.add_argument("--concurrency", type=int, default=4, help="number of sessions in flight at once")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds before the first token of every call")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="generation speed of the answers")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="seconds per embedding call")
+    parser.add_argument("--embedding-batch-window", type=float, default=None, help="seconds to batch query embeddings")
+    parser.add_argument("--graph-options", type=json.loads, default=None, help="JSON object of AssistantGraph arguments")
+    parser.add_argument("--output", default="benchmark_results.json", help="path of the JSON results")
+    args = parser.parse_args()
+    results = benchmark(
+        repeats=args.repeats,
+        concurrency=args.concurrency,
+        llm_latency=args.llm_latency,
+        tokens_per_second=args.tokens_per_second,
+        embedding_latency=args.embedding_latency,
+        embedding_batch_window=args.embedding_batch_window,
+        graph_options=args.graph_options,
+    )
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(json.dumps({run: results[run]["overall"] for run in ("cold", "warm")}, indent=2))
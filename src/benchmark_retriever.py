@@ -0,0 +1,68 @@
+"""Script to benchmark the load time and query latency of the Chroma and numpy retriever backends"""
+
+import argparse
+import statistics
+import time
+
+from langchain_community.vectorstores import Chroma
+
+from vector_index import VectorIndex
+
+VECTOR_DB_PATH = "data/chroma_db"
+VECTOR_INDEX_PATH = "data/vector_index"
+
+
+def time_calls(fn, queries, k):
+    """Returns the latency of each call in milliseconds"""
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        fn(query, k)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def summarize(name, load_ms, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+    print(f"{name:>6}: load {load_ms:8.2f} ms | query p50 {statistics.median(latencies):6.3f} ms, p95 {p95:6.3f} ms")
+
+
+def benchmark(vector_db_path=VECTOR_DB_PATH, vector_index_path=VECTOR_INDEX_PATH, num_queries=200, k=4):
+    """
+    Times loading each backend and searching it with stored chunk embeddings as queries, so no embedding calls are made
+
+    Args:
+        vector_db_path (str): The persist directory of the vector store
+        vector_index_path (str): The directory of the memory-mapped vector index
+        num_queries (int): Number of searches to time per backend
+        k (int): Number of documents to retrieve per search
+    """
+    # the first query is included in the load time, as chroma loads its HNSW index lazily
+    start = time.perf_counter()
+    db = Chroma(persist_directory=vector_db_path)
+    stored = db.get(include=["embeddings"])["embeddings"]
+    queries = [stored[i % len(stored)] for i in range(num_queries)]
+    db.similarity_search_by_vector(queries[0], k=k)
+    chroma_load_ms = (time.perf_counter() - start) * 1000
+    chroma_latencies = time_calls(lambda query, k: db.similarity_search_by_vector(query, k=k), queries, k)
+
+    start = time.perf_counter()
+    index = VectorIndex(vector_index_path)
+    index.search(queries[0], k=k)
+    numpy_load_ms = (time.perf_counter() - start) * 1000
+    numpy_latencies = time_calls(index.search, queries, k)
+
+    print(f"{len(index)} chunks, {num_queries} queries, k={k}")
+    summarize("chroma", chroma_load_ms, chroma_latencies)
+    summarize("numpy", numpy_load_ms, numpy_latencies)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--vector-db", default=VECTOR_DB_PATH, help="persist directory of the vector store")
+    parser.add_argument("--vector-index", default=VECTOR_INDEX_PATH, help="directory of the memory-mapped vector index")
+    parser.add_argument("--queries", type=int, default=200, help="number of searches to time per backend")
+    parser.add_argument("-k", type=int, default=4, help="number of documents to retrieve per search")
+    args = parser.parse_args()
+    benchmark(vector_db_path=args.vector_db, vector_index_path=args.vector_index, num_queries=args.queries, k=args.k)
@@ -0,0 +1,80 @@
+"""Implements a compact in-memory BM25 inverted index over the chunked documents"""
+
+import json
+import math
+import os
+import re
+from collections import Counter
+
+from langchain_core.documents import Document
+
+
+def tokenize(text):
+    """Returns the lowercased word tokens of a text"""
+    return re.findall(r"\w+", text.lower())
+
+
+class BM25Index:
+    """Scores documents against a query with Okapi BM25, using an inverted index from term to postings"""
+
+    def __init__(self, documents, postings, doc_lengths, k1=1.5, b=0.75):
+        """
+        Args:
+            documents (list): The indexed documents
+            postings (dict): Maps each term to a list of (document index, term frequency) pairs
+            doc_lengths (list): The number of tokens in each document
+            k1 (float): Term frequency saturation
+            b (float): Document length normalization
+        """
+        self.documents = documents
+        self.postings = postings
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self.avg_doc_length = sum(doc_lengths) / len(doc_lengths) if doc_lengths else 0
+        # precompute the idf of every term once, instead of per query
+        n = len(documents)
+        self.idf = {term: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for term, p in postings.items()}
+
+    @classmethod
+    def build(cls, documents, **kwargs):
+        """Builds the index over a list of documents"""
+        postings, doc_lengths = {}, []
+        for i, document in enumerate(documents):
+            tokens = tokenize(document.page_content)
+            doc_lengths.append(len(tokens))
+            for term, frequency in Counter(tokens).items():
+                postings.setdefault(term, []).append((i, frequency))
+        return cls(documents, postings, doc_lengths, **kwargs)
+
+    def save(self, path):
+        """Writes the index to a JSON file"""
+        data = {
+            "documents": [{"page_content": d.page_content, "metadata": d.metadata} for d in self.documents],
+            "postings": self.postings,
+            "doc_lengths": self.doc_lengths,
+        }
+        with open(path + ".tmp", "w") as file:
+            json.dump(data, file)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """Reads an index written by save"""
+        with open(path, "r") as file:
+            data = json.load(file)
+        documents = [Document(**document) for document in data["documents"]]
+        postings = {term: [tuple(posting) for posting in p] for term, p in data["postings"].items()}
+        return cls(documents, postings, data["doc_lengths"], **kwargs)
+
+    def search(self, query, k=4):
+        """Returns the k highest scoring documents and their BM25 scores, highest first"""
+        scores = Counter()
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for i, frequency in self.postings[term]:
+                length_norm = 1 - self.b + self.b * self.doc_lengths[i] / self.avg_doc_length
+                scores[i] += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+        return [(self.documents[i], score) for i, score in scores.most_common(k)]
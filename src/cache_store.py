@@ -0,0 +1,168 @@
+"""Implements the building blocks shared by the caches: an LRU store backed by SQLite, and a file-derived version"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    """Returns the text lowercased with its whitespace collapsed"""
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def manifest_corpus_version(path):
+    """Returns the corpus version recorded in an ingestion manifest"""
+    with open(path) as file:
+        return json.load(file).get("corpus_version")
+
+
+class PersistentLRU:
+    """
+    A thread-safe in-memory LRU cache of JSON-serializable values, backed by an optional persistent SQLite table.
+
+    Every row records the version it was written under, and rows of another version are dropped when the version
+    changes. The table can be shared by the workers on a host. It is bounded by a maximum number of rows and an
+    optional ttl, pruned oldest first every prune_every writes.
+    """
+
+    def __init__(self, table, persist_path=None, max_size=4096, max_rows=100_000, ttl=None, prune_every=256):
+        """
+        Args:
+            table (str): Name of the SQLite table
+            persist_path (str): Path of an SQLite file to persist the values to, None to keep them in memory only
+            max_size (int): Maximum number of values kept in memory
+            max_rows (int): Maximum number of rows kept in the table, None for no bound
+            ttl (float): Seconds after which a value expires, None to never expire
+            prune_every (int): Number of writes between two prunings of the table
+        """
+        self.table = table
+        self.max_size = max_size
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.prune_every = prune_every
+        self.version = ""
+        self._lock = threading.Lock()
+        # key -> (value, created at)
+        self._memory = OrderedDict()
+        self._writes = 0
+        self._db = None
+        if persist_path:
+            self._db = sqlite3.connect(persist_path, check_same_thread=False, timeout=30)
+            # let the workers sharing the file read while one of them writes
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT, version TEXT, created_at REAL)"
+            )
+            self._db.execute(f"CREATE INDEX IF NOT EXISTS {table}_created_at ON {table} (created_at)")
+
+    def _expired(self, created_at, now):
+        return self.ttl is not None and now - created_at > self.ttl
+
+    def _remember(self, key, value, created_at):
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def _get(self, key, now):
+        if key in self._memory:
+            value, created_at = self._memory[key]
+            if not self._expired(created_at, now):
+                self._memory.move_to_end(key)
+                return value
+            del self._memory[key]
+        if self._db is not None:
+            row = self._db.execute(
+                f"SELECT value, created_at FROM {self.table} WHERE key = ? AND version = ?", (key, self.version)
+            ).fetchone()
+            if row is not None and not self._expired(row[1], now):
+                value = json.loads(row[0])
+                self._remember(key, value, row[1])
+                return value
+        return None
+
+    def get_many(self, keys):
+        """Returns the cached value of each key from memory, then the persistent store, None for the misses"""
+        now = time.time()
+        with self._lock:
+            return [self._get(key, now) for key in keys]
+
+    def put_many(self, items):
+        """Caches the values of a list of (key, value) pairs"""
+        now = time.time()
+        with self._lock:
+            for key, value in items:
+                self._remember(key, value, now)
+            if self._db is None:
+                return
+            with self._db:
+                self._db.executemany(
+                    f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)",
+                    [(key, json.dumps(value), self.version, now) for key, value in items],
+                )
+            self._writes += len(items)
+            if self._writes >= self.prune_every:
+                self._writes = 0
+                self._prune(now)
+
+    def _prune(self, now):
+        """Deletes the expired rows, then the oldest rows beyond max_rows"""
+        with self._db:
+            if self.ttl is not None:
+                self._db.execute(f"DELETE FROM {self.table} WHERE created_at < ?", (now - self.ttl,))
+            if self.max_rows is not None:
+                self._db.execute(
+                    f"DELETE FROM {self.table} WHERE key IN "
+                    f"(SELECT key FROM {self.table} ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_rows,),
+                )
+
+    def set_version(self, version):
+        """Drops every value written under another version, then caches values under the given one"""
+        version = version or ""
+        with self._lock:
+            if version == self.version:
+                return
+            self.version = version
+            self._memory.clear()
+            if self._db is not None:
+                with self._db:
+                    self._db.execute(f"DELETE FROM {self.table} WHERE version != ?", (version,))
+
+
+class FileVersion:
+    """
+    Tracks a version derived from a file, e.g. its content hash, only rederiving it when the file's size or mtime
+    changed. A file that is missing or cannot be read, e.g. while another process rewrites it, keeps the last version.
+    """
+
+    def __init__(self, path, read_version):
+        """
+        Args:
+            path (str): The file the version is derived from, None to never change version
+            read_version (callable): Returns the version of the file at the given path
+        """
+        self.path = path
+        self.read_version = read_version
+        self.version = None
+        self._stat = None
+
+    def check(self):
+        """Returns the current version of the file, None until it could be read once"""
+        if self.path is None:
+            return self.version
+        try:
+            stat = os.stat(self.path)
+            file_stat = (stat.st_mtime_ns, stat.st_size)
+            if file_stat == self._stat:
+                return self.version
+            version = self.read_version(self.path)
+        except (OSError, ValueError):
+            return self.version
+        self._stat = file_stat
+        self.version = version
+        return version
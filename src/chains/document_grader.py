@@ -6,12 +6,22 @@ from langchain.output_parsers.openai_tools import PydanticToolsParser
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import PromptTemplate
 from textwrap import dedent
+import asyncio
+import contextvars
+import hashlib
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import os
 from dotenv import load_dotenv
 
+from metrics import instrument
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Data model
 class grade(BaseModel):
     """Binary score for relevance check."""
@@ -32,10 +42,17 @@ class DocumentGrader:
     
     _GRADER_PROMPT = PromptTemplate(template=dedent(_GRADER_PROMPT_TEMPLATE), input_variables=["context", "question"])
     
-    def __init__(self):
-        # seperate the model wrapper instance for the binded tool
-        llm = ChatOpenAI(temperature=0, model=os.environ["OPENAI_MODEL"])
+    def __init__(self, request_timeout=None, llm=None, cache=None):
+        # seperate the model wrapper instance for the binded tool, unless one is given
+        if llm is None:
+            llm = ChatOpenAI(temperature=0, model=os.environ["OPENAI_MODEL"], request_timeout=request_timeout)
         grade_tool_oai = convert_to_openai_tool(grade)
+        # verdicts are cached per grader version, so a prompt, tool or model change never reuses them
+        self.cache = cache
+        model_name = getattr(llm, "model_name", type(llm).__name__)
+        self.version = hashlib.sha256(
+            f"{model_name}\n{self._GRADER_PROMPT_TEMPLATE}\n{json.dumps(grade_tool_oai, sort_keys=True)}".encode()
+        ).hexdigest()
         # LLM with tool and enforce invocation
         llm_with_tool = llm.bind(
             tools=[grade_tool_oai],
@@ -45,6 +62,158 @@ class DocumentGrader:
         parser_tool = PydanticToolsParser(tools=[grade])
         self._grader_chain = self._GRADER_PROMPT | llm_with_tool | parser_tool
         
+    @instrument("document_grader")
     def run(self, question, context):
         """Returns the response from the document grader"""
         return self._grader_chain.invoke({"context": context, "question": question})
+
+    @instrument("document_grader_batch")
+    def run_batch(self, question, contexts, max_concurrency=4):
+        """Returns the responses from the document grader for several contexts, an exception for each failed call"""
+        inputs = [{"context": context, "question": question} for context in contexts]
+        return self._grader_chain.batch(inputs, config={"max_concurrency": max_concurrency}, return_exceptions=True)
+
+    def _grade(self, question, context):
+        """Returns the binary score for a single context, None for a failed or timed out call"""
+        try:
+            score = self.run(question=question, context=context)[0].binary_score
+        except Exception as e:
+            logger.warning("document grader call failed: %r", e)
+            return None
+        self._remember(question, context, score)
+        return score
+
+    def _remember(self, question, context, score):
+        """Caches a verdict the grader returned, failed calls are not cached"""
+        if self.cache is not None:
+            self.cache.put(self.version, question, context, score)
+
+    def _cached_scores(self, question, contexts, max_relevant):
+        """
+        Returns the cached scores, the indices of the contexts left to grade, and the relevant contexts still to find
+
+        Args:
+            question (str): The standalone question
+            contexts (list): The contexts to grade
+            max_relevant (int): Stop once this many relevant contexts are found, None for no limit
+
+        Returns:
+            tuple: The scores with 'no' for the uncached contexts, the uncached indices, and max_relevant less the
+                cached relevant contexts
+        """
+        cached = self.cache.get_many(self.version, question, contexts) if self.cache is not None else [None] * len(contexts)
+        scores = [score or "no" for score in cached]
+        uncached = [i for i, score in enumerate(cached) if score is None]
+        if max_relevant is not None:
+            max_relevant = max(max_relevant - cached.count("yes"), 0)
+        return scores, uncached, max_relevant
+
+    def run_many(self, question, contexts, max_concurrency=4, max_relevant=None, with_failures=False):
+        """
+        Grades several contexts against the same question concurrently.
+
+        Failed calls are logged and score 'no'.
+
+        Args:
+            question (str): The standalone question
+            contexts (list): The contexts to grade
+            max_concurrency (int): Maximum number of grader calls in flight at once
+            max_relevant (int): Stop once this many relevant contexts are found, cancelling the calls not yet started
+            with_failures (bool): Whether to also return the number of failed grader calls
+
+        Returns:
+            list: The binary score for each context, in the same order as contexts, and the number of failed calls
+                with with_failures
+        """
+        scores, failures = self._run_many(question, contexts, max_concurrency, max_relevant)
+        return (scores, failures) if with_failures else scores
+
+    def _run_many(self, question, contexts, max_concurrency, max_relevant):
+        if not contexts or max_relevant == 0:
+            return ["no"] * len(contexts), 0
+        # only the contexts without a cached verdict are sent to the grader
+        scores, uncached, max_relevant = self._cached_scores(question, contexts, max_relevant)
+        if not uncached or max_relevant == 0:
+            return scores, 0
+        failures = 0
+        if max_relevant is None:
+            results = self.run_batch(question, [contexts[i] for i in uncached], max_concurrency=max_concurrency)
+            for i, result in zip(uncached, results):
+                if isinstance(result, Exception) or not result:
+                    logger.warning("document grader call failed: %r", result)
+                    failures += 1
+                    continue
+                scores[i] = result[0].binary_score
+                self._remember(question, contexts[i], scores[i])
+            return scores, failures
+        executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        # each call runs in a copy of the current context, so it counts towards the current turn's metrics
+        futures = {
+            executor.submit(contextvars.copy_context().run, self._grade, question, contexts[i]): i
+            for i in uncached
+        }
+        relevant = 0
+        try:
+            for future in as_completed(futures):
+                score = future.result()
+                if score is None:
+                    failures += 1
+                    continue
+                scores[futures[future]] = score
+                if score == "yes":
+                    relevant += 1
+                    if relevant >= max_relevant:
+                        break
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        return scores, failures
+
+    @instrument("document_grader")
+    async def arun(self, question, context):
+        """Asynchronously returns the response from the document grader"""
+        return await self._grader_chain.ainvoke({"context": context, "question": question})
+
+    async def _agrade(self, question, context, semaphore):
+        """Asynchronously returns the binary score for a single context, None for a failed or timed out call"""
+        async with semaphore:
+            try:
+                score = (await self.arun(question=question, context=context))[0].binary_score
+            except Exception as e:
+                logger.warning("document grader call failed: %r", e)
+                return None
+            self._remember(question, context, score)
+            return score
+
+    async def arun_many(self, question, contexts, max_concurrency=4, max_relevant=None, with_failures=False):
+        """Async counterpart of run_many, the calls still in flight are cancelled on an early stop"""
+        scores, failures = await self._arun_many(question, contexts, max_concurrency, max_relevant)
+        return (scores, failures) if with_failures else scores
+
+    async def _arun_many(self, question, contexts, max_concurrency, max_relevant):
+        if not contexts or max_relevant == 0:
+            return ["no"] * len(contexts), 0
+        scores, uncached, max_relevant = self._cached_scores(question, contexts, max_relevant)
+        if not uncached or max_relevant == 0:
+            return scores, 0
+        failures = 0
+        semaphore = asyncio.Semaphore(max_concurrency)
+        tasks = {asyncio.ensure_future(self._agrade(question, contexts[i], semaphore)): i for i in uncached}
+        pending = set(tasks)
+        relevant = 0
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    score = task.result()
+                    if score is None:
+                        failures += 1
+                        continue
+                    scores[tasks[task]] = score
+                    if score == "yes":
+                        relevant += 1
+                if max_relevant is not None and relevant >= max_relevant:
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+        return scores, failures
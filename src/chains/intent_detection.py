@@ -4,6 +4,8 @@ from langchain.chains import create_tagging_chain
 from langchain_core.prompts import ChatPromptTemplate
 from textwrap import dedent
 
+from metrics import instrument
+
 class IntentDetection:
     
     """Implements the intents detection chain"""
@@ -37,8 +39,14 @@ class IntentDetection:
     def __init__(self, llm):
         self.tagging_chain = create_tagging_chain(self._SCHEMA, llm, prompt=self._TAGGING_PROMPT_TEMPLATE)
     
+    @instrument("intent_detection")
     def run(self, message, history):
         """Returns the detected intent"""
         result = self.tagging_chain.invoke({"input": message, "history": history})
         return result["text"]["intent"]
-        
+
+    @instrument("intent_detection")
+    async def arun(self, message, history):
+        """Asynchronously returns the detected intent"""
+        result = await self.tagging_chain.ainvoke({"input": message, "history": history})
+        return result["text"]["intent"]
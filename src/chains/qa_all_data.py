@@ -1,8 +1,16 @@
 """Implements a QA chain to run using the full data."""
 
+import json
+import os
+
+from langchain_core.documents import Document
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 
+from bm25 import tokenize
+from context_packing import count_tokens, pack_sections
+from metrics import instrument
+
 class QAAllData:
     """Implements a QA chain to run using the full data"""
 
@@ -17,11 +25,53 @@ class QAAllData:
 
     _PROMPT = ChatPromptTemplate.from_template(_PROMPT_TEMPLATE)
 
-    def __init__(self, llm, source_data_path):
+    _SECTION_SEPARATOR = "\n\n"
+
+    def __init__(self, llm, source_data_path, sections_path=None, token_budget=None):
+        """
+        Args:
+            llm: The chat model
+            source_data_path (str): The path to the full source data
+            sections_path (str): The header-split sections with token counts written by ingest_data.py
+            token_budget (int): Maximum number of context tokens, None to always use the full data
+        """
         with open(source_data_path, "r") as file:
             self.full_markdown_document = file.read()
+        self.token_budget = token_budget
+        self.model = getattr(llm, "model_name", None)
+        self.sections = []
+        if token_budget is not None and sections_path and os.path.exists(sections_path):
+            with open(sections_path, "r") as file:
+                self.sections = [Document(**section) for section in json.load(file)]
+        # the full data is used as is whenever it fits, so only pack when it does not
+        self.needs_packing = bool(self.sections) and count_tokens(self.full_markdown_document, self.model) > token_budget
+        # tokenize the sections once, so ranking them per question is only set intersections
+        self._header_tokens, self._content_tokens = [], []
+        for section in self.sections:
+            headers = " ".join(value for key, value in section.metadata.items() if key.startswith("Header"))
+            self._header_tokens.append(set(tokenize(headers)))
+            self._content_tokens.append(set(tokenize(section.page_content)))
         self.qa_all_data_chain = self._PROMPT | llm | StrOutputParser()
 
+    def _context(self, question):
+        """Returns the full data, or the most relevant sections that fit the token budget in document order"""
+        if not self.needs_packing:
+            return self.full_markdown_document
+        question_tokens = set(tokenize(question))
+        # rank by overlap with the section headers first, then with the section content, then by position
+        ranking = sorted(
+            range(len(self.sections)),
+            key=lambda i: (-len(question_tokens & self._header_tokens[i]), -len(question_tokens & self._content_tokens[i]), i),
+        )
+        packed = pack_sections([self.sections[i] for i in ranking], self.token_budget, model=self.model)
+        return self._SECTION_SEPARATOR.join(self.sections[i].page_content for i in sorted(ranking[j] for j in packed))
+
+    @instrument("qa_all_data")
     def run(self, question):
         """Returns the response from the LLM to the user's message using all data."""
-        return self.qa_all_data_chain.invoke({"question": question, "context": self.full_markdown_document})
\ No newline at end of file
+        return self.qa_all_data_chain.invoke({"question": question, "context": self._context(question)})
+
+    @instrument("qa_all_data")
+    async def arun(self, question, config=None):
+        """Asynchronously returns the response from the LLM to the user's message using all data."""
+        return await self.qa_all_data_chain.ainvoke({"question": question, "context": self._context(question)}, config=config)
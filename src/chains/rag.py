@@ -4,6 +4,9 @@ from langchain_core.prompts import format_document, PromptTemplate, ChatPromptTe
 from langchain_core.output_parsers import StrOutputParser
 from textwrap import dedent
 
+from context_packing import pack_sections
+from metrics import instrument
+
 class RAG:
     
     """Implements the RAG chain"""
@@ -22,14 +25,25 @@ class RAG:
     
     _RAG_PROMPT_TEMPLATE = ChatPromptTemplate.from_template(dedent(_RAG_PROMPT))
     
-    def __init__(self, llm):
+    def __init__(self, llm, token_budget=None):
+        self.token_budget = token_budget
+        self.model = getattr(llm, "model_name", None)
         self.rag_chain = self._RAG_PROMPT_TEMPLATE | llm | StrOutputParser()
     
     def _combine_documents(self, docs):
+        # the documents come ranked by retrieval, keep the most relevant ones that fit the token budget
+        docs = [docs[i] for i in pack_sections(docs, self.token_budget, model=self.model)]
         doc_strings = [format_document(doc, self._DEFAULT_DOCUMENT_PROMPT) for doc in docs]
         return self._DOCUMENT_SEPARATOR.join(doc_strings)
     
+    @instrument("rag")
     def run(self, question, documents):
         """Returns the response from the LLM to the user's message using RAG with chunked documents."""
         document_str = self._combine_documents(documents)
-        return self.rag_chain.invoke({"question": question, "context": document_str})
\ No newline at end of file
+        return self.rag_chain.invoke({"question": question, "context": document_str})
+
+    @instrument("rag")
+    async def arun(self, question, documents, config=None):
+        """Asynchronously returns the response from the LLM to the user's message using RAG with chunked documents."""
+        document_str = self._combine_documents(documents)
+        return await self.rag_chain.ainvoke({"question": question, "context": document_str}, config=config)
@@ -3,6 +3,8 @@
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 
+from metrics import instrument
+
 class RephraseQuestion:
     
     """Implements the rephrase question chain"""
@@ -19,6 +21,12 @@ class RephraseQuestion:
     def __init__(self, llm):
         self.rephrase_question_chain = self._CONDENSE_QUESTION_PROMPT | llm | StrOutputParser()
     
+    @instrument("rephrase_question")
     def run(self, message, history):
         """Returns the rephrased question from the LLM to the user's message."""
-        return self.rephrase_question_chain.invoke({"chat_history": history, "question": message})
\ No newline at end of file
+        return self.rephrase_question_chain.invoke({"chat_history": history, "question": message})
+
+    @instrument("rephrase_question")
+    async def arun(self, message, history):
+        """Asynchronously returns the rephrased question from the LLM to the user's message."""
+        return await self.rephrase_question_chain.ainvoke({"chat_history": history, "question": message})
@@ -4,6 +4,8 @@ from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from textwrap import dedent
 
+from metrics import instrument
+
 class Smalltalk:
     
     """Responds to any smalltalk or off-topic messages."""
@@ -22,7 +24,13 @@ class Smalltalk:
     def __init__(self, llm):
         self.smalltalk_chain = self._SMALLTALK_PROMPT_TEMPLATE | llm | StrOutputParser()   
     
+    @instrument("smalltalk")
     def run(self, message, history):
         """Returns the response from the LLM to the user's message."""
         return self.smalltalk_chain.invoke({"input": message, "chat_history": history})
+
+    @instrument("smalltalk")
+    async def arun(self, message, history, config=None):
+        """Asynchronously returns the response from the LLM to the user's message."""
+        return await self.smalltalk_chain.ainvoke({"input": message, "chat_history": history}, config=config)
         
\ No newline at end of file
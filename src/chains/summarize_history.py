@@ -0,0 +1,39 @@
+"""Implements the chain to fold chat turns into a rolling summary"""
+
+from langchain_core.prompts import PromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+from textwrap import dedent
+
+from metrics import instrument
+
+class SummarizeHistory:
+    
+    """Implements the chain to fold chat turns into a rolling summary"""
+    
+    _SUMMARIZE_PROMPT = """
+    Progressively summarize the lines of a conversation between a user and Saj, an AI assistant answering questions about Sajal Sharma, adding onto the previous summary and returning a new summary.
+    Keep every fact about Sajal that was asked about or given, and what the user was interested in. Keep the summary under 150 words.
+
+    Current summary:
+    {summary}
+
+    New lines of conversation:
+    {new_lines}
+
+    New summary:
+    """
+    
+    _SUMMARIZE_PROMPT_TEMPLATE = PromptTemplate.from_template(dedent(_SUMMARIZE_PROMPT))
+    
+    def __init__(self, llm):
+        self.summarize_chain = self._SUMMARIZE_PROMPT_TEMPLATE | llm | StrOutputParser()
+    
+    @instrument("summarize_history")
+    def run(self, summary, new_lines):
+        """Returns the summary with the new lines of conversation folded in."""
+        return self.summarize_chain.invoke({"summary": summary, "new_lines": new_lines})
+
+    @instrument("summarize_history")
+    async def arun(self, summary, new_lines):
+        """Asynchronously returns the summary with the new lines of conversation folded in."""
+        return await self.summarize_chain.ainvoke({"summary": summary, "new_lines": new_lines})
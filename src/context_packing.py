@@ -0,0 +1,60 @@
+"""Implements token counting and token-budgeted packing of context sections into prompts"""
+
+from functools import lru_cache
+
+import tiktoken
+
+TOKEN_COUNT_KEY = "tokens"
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model=None):
+    """Returns the tiktoken encoding of a model, falling back to cl100k_base for unknown models, or None if offline"""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        # unknown or missing model names raise, as does downloading a known model's encoding offline
+        pass
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # the encoding files are downloaded on first use, which fails without network access
+        return None
+
+
+def count_tokens(text, model=None):
+    """Returns the number of tokens in a text for the given model, estimated at four characters per token if offline"""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def section_tokens(document, model=None):
+    """Returns the token count of a section, using the count precomputed at ingestion when there is one"""
+    tokens = document.metadata.get(TOKEN_COUNT_KEY)
+    return tokens if tokens is not None else count_tokens(document.page_content, model)
+
+
+def pack_sections(sections, token_budget, model=None, separator_tokens=1):
+    """
+    Fills a token budget with sections in ranked order, skipping those that no longer fit
+
+    Args:
+        sections (list): The sections as documents, most relevant first
+        token_budget (int): Maximum number of tokens of the packed sections, None for no limit
+        model (str): The model the tokens are counted for
+        separator_tokens (int): Tokens taken by the separator between two sections
+
+    Returns:
+        list: The indices of the packed sections, in ranked order
+    """
+    if token_budget is None:
+        return list(range(len(sections)))
+    packed, used = [], 0
+    for i, section in enumerate(sections):
+        tokens = section_tokens(section, model) + (separator_tokens if packed else 0)
+        if used + tokens <= token_budget:
+            packed.append(i)
+            used += tokens
+    return packed
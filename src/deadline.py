@@ -0,0 +1,92 @@
+"""Implements per-request deadlines, carried in the graph state, and the timeouts of the chain calls made under them"""
+
+import asyncio
+import contextvars
+import functools
+import inspect
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+DEADLINE_KEY = "deadline"
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a call does not finish within its timeout, or the request's deadline has passed"""
+
+
+def deadline_after(seconds):
+    """Returns the deadline of a request with a latency budget of the given seconds"""
+    return time.monotonic() + seconds
+
+
+def time_left(deadline):
+    """Returns the seconds left until a deadline, None if there is no deadline"""
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def call_timeout(deadline, timeout=None):
+    """Returns the smaller of a call's own timeout and the time left until the deadline, None for no limit"""
+    left = time_left(deadline)
+    if left is None:
+        return timeout
+    return left if timeout is None else min(left, timeout)
+
+
+def call_with_timeout(executor, timeout, fn, *args, **kwargs):
+    """
+    Calls a function, giving up on it after a timeout
+
+    The call runs on the executor, in a copy of the current context, so the caller can stop waiting for it. A blocking
+    call cannot be interrupted, the abandoned call keeps running in the background until it returns.
+
+    Args:
+        executor: The executor the call runs on when it has a timeout
+        timeout (float): Seconds to wait for the result, None to call the function directly
+
+    Returns:
+        The function's result
+
+    Raises:
+        DeadlineExceeded: If the call did not return in time, or no time was left to make it
+    """
+    if timeout is None:
+        return fn(*args, **kwargs)
+    if timeout <= 0:
+        raise DeadlineExceeded("no time left to make the call")
+    future = executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        raise DeadlineExceeded(f"call did not return within {timeout:.2f}s") from None
+
+
+async def await_with_timeout(awaitable, timeout):
+    """Async counterpart of call_with_timeout, the awaitable is cancelled when it does not finish in time"""
+    if timeout is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, max(timeout, 0))
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(f"call did not return within {max(timeout, 0):.2f}s") from None
+
+
+def _carry(state, result):
+    deadline = state["keys"].get(DEADLINE_KEY)
+    if deadline is not None and DEADLINE_KEY not in result["keys"]:
+        result["keys"][DEADLINE_KEY] = deadline
+    return result
+
+
+def carry_deadline(node):
+    """Wraps a sync or async graph node to copy the request's deadline into the state it returns"""
+    if inspect.iscoroutinefunction(node):
+        @functools.wraps(node)
+        async def async_wrapper(state, *args, **kwargs):
+            return _carry(state, await node(state, *args, **kwargs))
+        return async_wrapper
+
+    @functools.wraps(node)
+    def wrapper(state, *args, **kwargs):
+        return _carry(state, node(state, *args, **kwargs))
+    return wrapper
@@ -0,0 +1,119 @@
+"""Implements the BatchingEmbeddings class for coalescing concurrent query embeddings into batched calls"""
+
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+
+from langchain_core.embeddings import Embeddings
+
+from metrics import record_embedding_batch
+
+
+class BatchingEmbeddings(Embeddings):
+    """
+    Wraps an embedding model to coalesce the queries of concurrent callers into one embed_documents call.
+
+    A background thread collects the queries arriving within max_wait of the first one, or until max_batch_size are
+    waiting, and embeds them in a single request, resolving each caller's future with its vector. Sync callers block on
+    the future and async callers await it, so both share the same batches. Lists of documents are already batched and
+    go straight to the model.
+    """
+
+    def __init__(self, embedding_model, max_wait=0.005, max_batch_size=64, max_concurrent_batches=4):
+        """
+        Args:
+            embedding_model: The embedding model to batch the queries of
+            max_wait (float): Seconds a batch waits for more queries after its first one
+            max_batch_size (int): Maximum number of queries embedded in one call
+            max_concurrent_batches (int): Maximum number of batch calls in flight at once
+        """
+        self.embedding_model = embedding_model
+        # keep the wrapped model's name, so caches in front of the batcher key on it
+        self.model = getattr(embedding_model, "model", type(embedding_model).__name__)
+        self.max_wait = max_wait
+        self.max_batch_size = max_batch_size
+        self.max_concurrent_batches = max_concurrent_batches
+        self.batches = 0
+        self.queries = 0
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _submit(self, text):
+        """Queues a query, returning the future of its embedding"""
+        with self._lock:
+            if self._executor is None:
+                # started on first use, so building the batcher spawns no threads
+                self._executor = ThreadPoolExecutor(max_workers=self.max_concurrent_batches, thread_name_prefix="embedding-batch")
+                threading.Thread(target=self._collect, name="embedding-batcher", daemon=True).start()
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def _collect(self):
+        """Forms batches from the queued queries and hands them to the executor, forever"""
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._executor.submit(self._embed_batch, batch)
+
+    @staticmethod
+    def _resolve(future, result=None, exception=None):
+        # a caller that gave up may have cancelled its future
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        except InvalidStateError:
+            pass
+
+    def _embed_batch(self, batch):
+        # identical queries in a batch are embedded once
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            embeddings = dict(zip(texts, self.embedding_model.embed_documents(texts)))
+        except Exception as e:
+            for _, future in batch:
+                self._resolve(future, exception=e)
+            return
+        for text, future in batch:
+            self._resolve(future, result=embeddings[text])
+        with self._lock:
+            self.batches += 1
+            self.queries += len(batch)
+        record_embedding_batch(len(texts))
+
+    def embed_documents(self, texts):
+        """Embeds a list of texts in a call of its own"""
+        return self.embedding_model.embed_documents(texts)
+
+    async def aembed_documents(self, texts):
+        """Asynchronously embeds a list of texts in a call of its own"""
+        return await self.embedding_model.aembed_documents(texts)
+
+    def embed_query(self, text):
+        """Embeds a query in the next batch, blocking until its vector is back"""
+        return self._submit(text).result()
+
+    async def aembed_query(self, text):
+        """Embeds a query in the next batch, without blocking the event loop"""
+        return await asyncio.wrap_future(self._submit(text))
+
+    def stats(self):
+        """Returns the number of batch calls, the queries they embedded, and the mean queries per call"""
+        return {
+            "batches": self.batches,
+            "queries": self.queries,
+            "mean_batch_size": round(self.queries / self.batches, 3) if self.batches else 0.0,
+        }
@@ -0,0 +1,99 @@
+"""Implements the CachedEmbeddings class for reusing embeddings of previously embedded text"""
+
+import hashlib
+import threading
+
+from langchain_core.embeddings import Embeddings
+
+from cache_store import PersistentLRU, normalize_text
+from metrics import record_cache_hit
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embedding model with an in-memory LRU cache backed by an optional persistent SQLite store.
+
+    Entries are keyed on the normalized text and the name of the embedding model, so switching models never
+    returns stale vectors.
+    """
+
+    def __init__(self, embedding_model, persist_path=None, max_size=4096, max_rows=100_000):
+        """
+        Args:
+            embedding_model: The embedding model to cache
+            persist_path (str): Path of an SQLite file to persist the embeddings to, None to keep them in memory only
+            max_size (int): Maximum number of embeddings kept in memory
+            max_rows (int): Maximum number of embeddings kept in the SQLite file, None for no bound
+        """
+        self.embedding_model = embedding_model
+        self.model_name = getattr(embedding_model, "model", type(embedding_model).__name__)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._store = PersistentLRU("embeddings", persist_path, max_size=max_size, max_rows=max_rows)
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model_name}\n{normalize_text(text)}".encode()).hexdigest()
+
+    def _get_many(self, keys):
+        """Returns the cached embedding of each key from memory, then the persistent store, None for the misses"""
+        embeddings = self._store.get_many(keys)
+        hits = sum(embedding is not None for embedding in embeddings)
+        with self._lock:
+            self.hits += hits
+            self.misses += len(embeddings) - hits
+        for _ in range(hits):
+            record_cache_hit("embedding")
+        return embeddings
+
+    def _put(self, keys, embeddings):
+        self._store.put_many(list(zip(keys, embeddings)))
+
+    def _lookup_many(self, texts):
+        """Returns the keys, the cached embeddings (None for misses), and the indices of the misses"""
+        keys = [self._key(text) for text in texts]
+        embeddings = self._get_many(keys)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        return keys, embeddings, missing
+
+    def embed_documents(self, texts):
+        """Embeds a list of texts, only sending the uncached ones to the embedding model"""
+        keys, embeddings, missing = self._lookup_many(texts)
+        if missing:
+            computed = self.embedding_model.embed_documents([texts[i] for i in missing])
+            for i, embedding in zip(missing, computed):
+                embeddings[i] = embedding
+            self._put([keys[i] for i in missing], computed)
+        return embeddings
+
+    async def aembed_documents(self, texts):
+        """Asynchronously embeds a list of texts, only sending the uncached ones to the embedding model"""
+        keys, embeddings, missing = self._lookup_many(texts)
+        if missing:
+            computed = await self.embedding_model.aembed_documents([texts[i] for i in missing])
+            for i, embedding in zip(missing, computed):
+                embeddings[i] = embedding
+            self._put([keys[i] for i in missing], computed)
+        return embeddings
+
+    def embed_query(self, text):
+        """Embeds a query, returning the cached embedding when there is one"""
+        key = self._key(text)
+        embedding = self._get_many([key])[0]
+        if embedding is None:
+            embedding = self.embedding_model.embed_query(text)
+            self._put([key], [embedding])
+        return embedding
+
+    async def aembed_query(self, text):
+        """Asynchronously embeds a query, returning the cached embedding when there is one"""
+        key = self._key(text)
+        embedding = self._get_many([key])[0]
+        if embedding is None:
+            embedding = await self.embedding_model.aembed_query(text)
+            self._put([key], [embedding])
+        return embedding
+
+    def stats(self):
+        """Returns the hit and miss counters"""
+        return {"hits": self.hits, "misses": self.misses}
@@ -0,0 +1,139 @@
+"""Implements deterministic local stand-ins for the chat and embedding models, used to benchmark without OpenAI calls"""
+
+import asyncio
+import hashlib
+import json
+import re
+import time
+from typing import Any, List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from bm25 import tokenize
+
+# words that make the stand-in intent detector answer sajal_question
+SAJAL_WORDS = {"sajal", "he", "his", "him", "work", "worked", "experience", "contact", "email", "phone", "education",
+               "certifications", "hobbies", "skills", "projects", "study", "studied"}
+STOPWORDS = {"what", "does", "where", "when", "which", "about", "with", "have", "that", "this", "there", "tell",
+             "sajal", "sharma", "from", "they", "their", "your", "could", "would"}
+
+
+def _stable_hash(text):
+    return int(hashlib.md5(text.encode()).hexdigest(), 16)
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    A chat model returning deterministic responses after a configurable delay.
+
+    Calls bound to the grade tool (DocumentGrader) answer 'yes' when the document shares a content word with the
+    question, calls bound to a function (IntentDetection) tag messages mentioning Sajal as sajal_question, rephrasing
+    returns the follow up question unchanged, and any other call generates a fixed length answer derived from the
+    prompt, streamed token by token.
+    """
+
+    latency: float = 0.0
+    """Seconds before the first token of every call"""
+    tokens_per_second: float = 0.0
+    """Generation speed of the answers, 0 for instant"""
+    answer_tokens: int = 40
+    """Number of tokens of a generated answer"""
+    model_name: str = "fake-chat-model"
+
+    @property
+    def _llm_type(self):
+        return "fake-chat-model"
+
+    def _grade(self, prompt):
+        document = re.search(r"Retrieved document:(.*)User Question:", prompt, re.S)
+        question = re.search(r"User Question:(.*?)\n", prompt)
+        if document is None or question is None:
+            return "no"
+        question_words = {w for w in tokenize(question.group(1)) if len(w) > 3 and w not in STOPWORDS}
+        return "yes" if question_words & set(tokenize(document.group(1))) else "no"
+
+    def _respond(self, prompt, kwargs):
+        """Returns the response message and its tokens, in the shape the chains' output parsers expect"""
+        if "tools" in kwargs:
+            name = kwargs["tools"][0]["function"]["name"]
+            arguments = json.dumps({"binary_score": self._grade(prompt)})
+            tool_call = {
+                "id": f"call_{_stable_hash(prompt) % 10**8}",
+                "type": "function",
+                "function": {"name": name, "arguments": arguments},
+            }
+            return AIMessage(content="", additional_kwargs={"tool_calls": [tool_call]}), []
+        if "functions" in kwargs:
+            name = kwargs["functions"][0]["name"]
+            passage = prompt.rsplit("Passage:", 1)[-1]
+            intent = "sajal_question" if SAJAL_WORDS & set(tokenize(passage)) else "smalltalk"
+            function_call = {"name": name, "arguments": json.dumps({"intent": intent})}
+            return AIMessage(content="", additional_kwargs={"function_call": function_call}), []
+        follow_up = re.search(r"Follow Up Input:(.*?)\n\s*Standalone question:", prompt, re.S)
+        if follow_up is not None:
+            # rephrasing returns the question as is, so retrieval sees the scripted words
+            question = follow_up.group(1).strip()
+            return AIMessage(content=question), question.split()
+        seed = _stable_hash(prompt)
+        tokens = [f"word{(seed + i) % 997} " for i in range(self.answer_tokens)]
+        return AIMessage(content="".join(tokens).strip()), tokens
+
+    def _result(self, prompt, message):
+        usage = {"prompt_tokens": len(prompt.split()), "completion_tokens": len(message.content.split())}
+        return ChatResult(generations=[ChatGeneration(message=message)], llm_output={"token_usage": usage})
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs: Any):
+        prompt = "\n".join(str(message.content) for message in messages)
+        message, tokens = self._respond(prompt, kwargs)
+        time.sleep(self.latency)
+        for token in tokens:
+            if self.tokens_per_second:
+                time.sleep(1 / self.tokens_per_second)
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=ChatGenerationChunk(message=AIMessageChunk(content=token)))
+        return self._result(prompt, message)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs: Any):
+        prompt = "\n".join(str(message.content) for message in messages)
+        message, tokens = self._respond(prompt, kwargs)
+        await asyncio.sleep(self.latency)
+        for token in tokens:
+            if self.tokens_per_second:
+                await asyncio.sleep(1 / self.tokens_per_second)
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=ChatGenerationChunk(message=AIMessageChunk(content=token)))
+        return self._result(prompt, message)
+
+
+class FakeEmbeddings(Embeddings):
+    """Embeds texts as normalized hashed bags of words after a configurable delay, so texts sharing words are similar"""
+
+    def __init__(self, size=256, latency=0.0):
+        self.size = size
+        self.latency = latency
+        self.model = "fake-embeddings"
+
+    def _embed(self, text):
+        vector = np.zeros(self.size, dtype=np.float32)
+        for token in tokenize(text):
+            vector[_stable_hash(token) % self.size] += 1
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]):
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str):
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]):
+        await asyncio.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    async def aembed_query(self, text: str):
+        return (await self.aembed_documents([text]))[0]
@@ -0,0 +1,73 @@
+"""Implements the GradeCache class for reusing the document grader's verdicts on previously graded chunks"""
+
+import hashlib
+import threading
+
+from cache_store import FileVersion, PersistentLRU, manifest_corpus_version, normalize_text
+from metrics import record_cache_hit
+
+
+class GradeCache:
+    """
+    Caches the document grader's verdicts in an in-memory LRU cache backed by an optional persistent SQLite store.
+
+    Verdicts are keyed on the normalized question, the content hash of the chunk and the grader version, which covers
+    its prompt and model, so changing either never returns stale verdicts. The store can be shared by the workers on a
+    host. Every verdict is dropped when the corpus version in the ingestion manifest changes, i.e. on re-ingestion.
+    """
+
+    def __init__(self, manifest_path=None, persist_path=None, max_size=4096, max_rows=100_000, ttl=7 * 24 * 3600):
+        """
+        Args:
+            manifest_path (str): The ingestion manifest holding the corpus version, None to never invalidate
+            persist_path (str): Path of an SQLite file to persist the verdicts to, None to keep them in memory only
+            max_size (int): Maximum number of verdicts kept in memory
+            max_rows (int): Maximum number of verdicts kept in the SQLite file, None for no bound
+            ttl (float): Seconds after which a verdict expires, None to never expire
+        """
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._corpus = FileVersion(manifest_path, manifest_corpus_version)
+        self._store = PersistentLRU("grade_cache", persist_path, max_size=max_size, max_rows=max_rows, ttl=ttl)
+        self._check_corpus()
+
+    def _key(self, version, question, context):
+        context_hash = hashlib.sha256(context.encode()).hexdigest()
+        return hashlib.sha256(f"{version}\n{normalize_text(question)}\n{context_hash}".encode()).hexdigest()
+
+    def _check_corpus(self):
+        """Drops every verdict if the corpus was re-ingested"""
+        with self._lock:
+            self._store.set_version(self._corpus.check())
+
+    def get_many(self, version, question, contexts):
+        """
+        Returns the cached verdicts of the contexts graded against a question
+
+        Args:
+            version (str): The grader version
+            question (str): The standalone question
+            contexts (list): The chunk contents
+
+        Returns:
+            list: The 'yes' or 'no' verdict of each context, None for the ones not cached
+        """
+        self._check_corpus()
+        verdicts = self._store.get_many([self._key(version, question, context) for context in contexts])
+        hits = len(verdicts) - verdicts.count(None)
+        with self._lock:
+            self.hits += hits
+            self.misses += len(verdicts) - hits
+        for _ in range(hits):
+            record_cache_hit("grade")
+        return verdicts
+
+    def put(self, version, question, context, verdict):
+        """Caches the verdict of a context graded against a question"""
+        self._check_corpus()
+        self._store.put_many([(self._key(version, question, context), verdict)])
+
+    def stats(self):
+        """Returns the hit and miss counters"""
+        return {"hits": self.hits, "misses": self.misses}
@@ -1,5 +1,11 @@
 """Implements the graph to handle workflows for the Sajal assistant"""
 
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from typing import Dict, TypedDict
 
 from chains.intent_detection import IntentDetection
@@ -9,10 +15,36 @@ from chains.rephrase_question import RephraseQuestion
 from chains.qa_all_data import QAAllData
 from chains.rag import RAG
 
+from deadline import (
+    DEADLINE_KEY,
+    DeadlineExceeded,
+    await_with_timeout,
+    call_timeout,
+    call_with_timeout,
+    carry_deadline,
+    deadline_after,
+    time_left,
+)
+from grade_cache import GradeCache
+from intent_router import IntentRouter
+from metrics import (
+    finish_request,
+    record_cache_hit,
+    record_degradation,
+    record_grading_decisions,
+    record_route,
+    start_request,
+    timed_node,
+)
+from model_routing import ModelRouter
 from retriever import Retriever
+from semantic_cache import SemanticCache
 
+from langchain_core.runnables import RunnableLambda
 from langgraph.graph import END, StateGraph
 
+logger = logging.getLogger(__name__)
+
 class GraphState(TypedDict):
     """
     Represents the state of our graph.
@@ -25,31 +57,282 @@ class GraphState(TypedDict):
 class AssistantGraph:
     
     """Implements the graph to handle workflows for the Sajal assistant"""
+
+    # tags the answering nodes, so their model tokens can be picked out of the graph's event stream
+    _ANSWER_TAG = "answer"
+
+    DEFAULT_DEGRADED_RESPONSE = (
+        "Sorry, I'm a little overloaded right now and couldn't answer in time. Please try asking again in a moment."
+    )
     
-    def __init__(self, llm, vector_db_path, source_data_path):
-        self.intent_detector = IntentDetection(llm)
-        self.smalltalk = Smalltalk(llm)
-        self.document_grader = DocumentGrader()
-        self.rephrase_question_chain = RephraseQuestion(llm)
-        self.retriever = Retriever(vector_db_path=vector_db_path)
-        self.qa_all_data = QAAllData(llm=llm, source_data_path=source_data_path)
-        self.rag = RAG(llm)
+    def __init__(
+        self,
+        llm,
+        vector_db_path,
+        source_data_path,
+        grading_max_concurrency=4,
+        grading_timeout=None,
+        grading_max_relevant=None,
+        grading_cascade=False,
+        grading_accept_threshold=0.9,
+        grading_reject_threshold=0.75,
+        use_grade_cache=True,
+        grade_cache_path=None,
+        grade_cache_size=4096,
+        use_semantic_cache=False,
+        semantic_cache_threshold=0.95,
+        semantic_cache_size=256,
+        semantic_cache_ttl=3600,
+        semantic_cache_path=None,
+        retriever_backend="chroma",
+        hybrid_retrieval=False,
+        retriever_options=None,
+        use_intent_router=False,
+        intent_examples=None,
+        intent_min_similarity=0.85,
+        intent_min_margin=0.05,
+        speculative=False,
+        speculative_retrieve=False,
+        skip_rephrase_without_history=True,
+        rag_token_budget=3000,
+        all_data_token_budget=8000,
+        sections_path=None,
+        embedding_model=None,
+        grader_llm=None,
+        time_budget=None,
+        node_timeout=None,
+        grading_skip_below=2.0,
+        grading_cap_below=5.0,
+        degraded_max_grader_calls=2,
+        degraded_response=DEFAULT_DEGRADED_RESPONSE,
+    ):
+        """
+        Args:
+            llm: The chat model used by the chains, or a ModelRouter giving each stage its own chat model
+            vector_db_path (str): The persist directory of the vector store
+            source_data_path (str): The path to the full source data
+            grading_max_concurrency (int): Maximum number of document grader calls run at once, 1 grades sequentially
+            grading_timeout (float): Timeout in seconds for each document grader call, a timed out call grades 'no',
+                overriding the timeout of the grade route
+            grading_max_relevant (int): Stop grading once this many relevant documents are found
+            grading_cascade (bool): Whether to grade documents by their retrieval similarity when it is clear cut,
+                only sending the ones in between the thresholds to the document grader
+            grading_accept_threshold (float): Similarity at or above which a document is relevant without an LLM call
+            grading_reject_threshold (float): Similarity below which a document is irrelevant without an LLM call
+            use_grade_cache (bool): Whether to reuse the grader's verdicts on previously graded question and chunk pairs,
+                until the corpus is re-ingested
+            grade_cache_path (str): Path of the SQLite file persisting the verdicts, defaults to a file next to the
+                vector store
+            grade_cache_size (int): Maximum number of verdicts kept in memory
+            use_semantic_cache (bool): Whether to answer questions similar to previously answered ones from a cache, off
+                by default as the similarity threshold has to be calibrated on the questions the assistant gets
+            semantic_cache_threshold (float): Minimum cosine similarity between standalone questions for a cache hit
+            semantic_cache_size (int): Maximum number of cached responses
+            semantic_cache_ttl (float): Seconds after which a cached response expires
+            semantic_cache_path (str): Path of an SQLite file to persist the cache to, None to keep it in memory
+            retriever_backend (str): "chroma" to search the Chroma store, "numpy" to search the memory-mapped vector index
+            hybrid_retrieval (bool): Whether to fuse the vector results with BM25 lexical results
+            retriever_options (dict): Further Retriever arguments, such as k, rrf_k, vector_weight and lexical_weight
+            use_intent_router (bool): Whether to decide confidently classified intents locally before calling the LLM,
+                off by default as its thresholds have to be calibrated on the messages the assistant gets
+            intent_examples (dict | str): Labelled examples per intent for the local classifier, or a JSON file with them
+            intent_min_similarity (float): Minimum similarity to the nearest intent centroid to decide locally
+            intent_min_margin (float): Minimum similarity lead of the nearest intent centroid to decide locally
+            speculative (bool): Whether to rephrase the question while the intent is being detected, discarding the
+                result if the message is routed to chat
+            speculative_retrieve (bool): Whether the speculative work also retrieves the documents
+            skip_rephrase_without_history (bool): Whether to use the message as the standalone question when there is
+                no chat history to rephrase it against
+            rag_token_budget (int): Maximum number of tokens of retrieved documents put in the RAG prompt
+            all_data_token_budget (int): Maximum number of context tokens of the all data prompt, the full data is
+                used as is when it fits
+            sections_path (str): The sections with token counts written by ingest_data.py, defaults to a file next to
+                the source data
+            embedding_model: The model embedding questions and queries, defaults to OpenAIEmbeddings
+            grader_llm: The chat model used by the document grader, defaults to the grade route's model when llm is a
+                ModelRouter, else to the grader's own OPENAI_MODEL instance
+            time_budget (float): Default latency budget of a turn in seconds, None for no deadline
+            node_timeout (float): Timeout in seconds for each chain call, also bounded by the time left in the budget
+            grading_skip_below (float): Seconds left under which grading is skipped and every retrieved document
+                not rejected by the cascade is used
+            grading_cap_below (float): Seconds left under which at most degraded_max_grader_calls documents are graded
+            degraded_max_grader_calls (int): Number of documents graded when grading is capped, the rest are dropped
+            degraded_response (str): The canned response of a turn that ran out of time
+        """
+        self.grading_max_concurrency = grading_max_concurrency
+        self.grading_max_relevant = grading_max_relevant
+        self.grading_cascade = grading_cascade
+        self.grading_accept_threshold = grading_accept_threshold
+        self.grading_reject_threshold = grading_reject_threshold
+        # how many documents each band of the grading cascade decided
+        self.grading_counters = {"accepted": 0, "rejected": 0, "llm_graded": 0}
+        self._grading_counters_lock = threading.Lock()
+        self.speculative = speculative
+        self.speculative_retrieve = speculative_retrieve
+        self.skip_rephrase_without_history = skip_rephrase_without_history
+        self.time_budget = time_budget
+        self.node_timeout = node_timeout
+        self.grading_skip_below = grading_skip_below
+        self.grading_cap_below = grading_cap_below
+        self.degraded_max_grader_calls = degraded_max_grader_calls
+        self.degraded_response = degraded_response
+        # runs the timed chain calls of the sync path, so a turn can stop waiting on a stalled call
+        self._deadline_executor = ThreadPoolExecutor(thread_name_prefix="deadline")
+        # runs the speculative work of the sync path, without blocking the chat route on discarded work
+        self._speculation_executor = ThreadPoolExecutor(thread_name_prefix="speculation") if speculative else None
+        self.model_router = llm if isinstance(llm, ModelRouter) else None
+        if self.model_router is not None and grader_llm is None:
+            overrides = {} if grading_timeout is None else {"timeout": grading_timeout}
+            grader_llm = self.model_router.llm("grade", **overrides)
+        self.smalltalk = Smalltalk(self._stage_llm(llm, "smalltalk"))
+        data_dir = os.path.dirname(os.path.normpath(vector_db_path))
+        # written by ingestion next to the vector store, its corpus version changes on every re-ingestion
+        manifest_path = os.path.join(data_dir, "manifest.json")
+        self.grade_cache = None
+        if use_grade_cache:
+            self.grade_cache = GradeCache(
+                manifest_path=manifest_path,
+                persist_path=grade_cache_path or os.path.join(data_dir, "grade_cache.sqlite3"),
+                max_size=grade_cache_size,
+            )
+        self.document_grader = DocumentGrader(request_timeout=grading_timeout, llm=grader_llm, cache=self.grade_cache)
+        self.rephrase_question_chain = RephraseQuestion(self._stage_llm(llm, "rephrase"))
+        self.retriever = Retriever(
+            vector_db_path=vector_db_path,
+            backend=retriever_backend,
+            hybrid=hybrid_retrieval,
+            embedding_model=embedding_model,
+            **(retriever_options or {}),
+        )
+        self.intent_detector = IntentDetection(self._stage_llm(llm, "intent"))
+        if use_intent_router:
+            self.intent_detector = IntentRouter(
+                intent_detector=self.intent_detector,
+                embedding_model=self.retriever.embedding_model,
+                examples=intent_examples,
+                min_similarity=intent_min_similarity,
+                min_margin=intent_min_margin,
+            )
+        self.semantic_cache = None
+        if use_semantic_cache:
+            self.semantic_cache = SemanticCache(
+                embedding_model=self.retriever.embedding_model,
+                source_data_path=source_data_path,
+                manifest_path=manifest_path,
+                similarity_threshold=semantic_cache_threshold,
+                max_size=semantic_cache_size,
+                ttl=semantic_cache_ttl,
+                persist_path=semantic_cache_path,
+            )
+        if sections_path is None:
+            sections_path = os.path.join(os.path.dirname(source_data_path), "sections.json")
+        self.qa_all_data = QAAllData(
+            llm=self._stage_llm(llm, "all_data"), source_data_path=source_data_path, sections_path=sections_path, token_budget=all_data_token_budget
+        )
+        self.rag = RAG(self._stage_llm(llm, "rag"), token_budget=rag_token_budget)
         self.app = self.compile_graph()
+
+    @staticmethod
+    def _stage_llm(llm, stage):
+        """Returns the chat model of a stage, routed if llm is a ModelRouter"""
+        return llm.llm(stage) if isinstance(llm, ModelRouter) else llm
         
-    def run(self, inputs):
-        return self.app.invoke(inputs)
+    def _with_deadline(self, inputs, time_budget):
+        """Returns the inputs with the deadline of the turn's latency budget, unless the caller already set one"""
+        time_budget = self.time_budget if time_budget is None else time_budget
+        if time_budget is None or DEADLINE_KEY in inputs["keys"]:
+            return inputs
+        return {"keys": {**inputs["keys"], DEADLINE_KEY: deadline_after(time_budget)}}
+
+    def run(self, inputs, time_budget=None):
+        request_metrics = start_request()
+        try:
+            return self.app.invoke(self._with_deadline(inputs, time_budget))
+        finally:
+            finish_request(request_metrics)
+
+    async def arun(self, inputs, time_budget=None):
+        request_metrics = start_request()
+        try:
+            return await self.app.ainvoke(self._with_deadline(inputs, time_budget))
+        finally:
+            finish_request(request_metrics)
+
+    async def astream(self, inputs, time_budget=None):
+        """
+        Runs the graph and streams the response tokens of whichever answering node the message is routed to
+
+        Args:
+            inputs (dict): The graph inputs
+            time_budget (float): Latency budget of the turn in seconds, defaults to the graph's time_budget
+
+        Yields:
+            str: The response tokens as they are generated, or the full response if the answering node did not stream
+        """
+        streamed = False
+        request_metrics = start_request()
+        try:
+            # only the answering nodes' runs are tracked, the others' outputs, like the grader's, need not serialize
+            events = self.app.astream_events(
+                self._with_deadline(inputs, time_budget), version="v1", include_tags=[self._ANSWER_TAG]
+            )
+            async for event in events:
+                if self._ANSWER_TAG not in event["tags"]:
+                    continue
+                if event["event"] == "on_chat_model_stream":
+                    chunk = event["data"]["chunk"]
+                    token = getattr(chunk, "content", chunk)
+                    if token:
+                        streamed = True
+                        yield token
+                elif event["event"] == "on_chain_end":
+                    # the answering node itself ends with the graph state, its inner chains end with prompts and strings
+                    output = event["data"].get("output")
+                    if not isinstance(output, dict) or "response" not in output.get("keys", {}):
+                        continue
+                    if not streamed:
+                        yield output["keys"]["response"]
+                    elif "degraded" in output["keys"]:
+                        # the answer ran out of time part way through streaming
+                        yield "\n\n" + output["keys"]["response"]
+        finally:
+            finish_request(request_metrics)
+
+    def _node(self, name, func, afunc, answer=False):
+        """Returns a graph node timing its sync and async implementations and carrying the deadline, tagged if it answers the user"""
+        func, afunc = carry_deadline(func), carry_deadline(afunc)
+        node = RunnableLambda(timed_node(name, func), afunc=timed_node(name, afunc))
+        return node.with_config(tags=[self._ANSWER_TAG]) if answer else node
     
     # define graph nodes and edges and compile graph
     def compile_graph(self):
         workflow = StateGraph(GraphState)
-        ### define the nodes
-        workflow.add_node("detect_intent", self.detect_intent)
-        workflow.add_node("chat", self.chat)
-        workflow.add_node("rephrase_question", self.rephrase_question)
-        workflow.add_node("retrieve", self.retrieve)
-        workflow.add_node("grade_documents", self.grade_documents)
-        workflow.add_node("generate_answer_with_retrieved_documents", self.generate_answer_with_retrieved_documents)
-        workflow.add_node("generate_answer_using_all_data", self.generate_answer_using_all_data)
+        ### define the nodes, each with a sync implementation for run and an async one for arun
+        workflow.add_node("detect_intent", self._node("detect_intent", self.detect_intent, self.adetect_intent))
+        workflow.add_node("chat", self._node("chat", self.chat, self.achat, answer=True))
+        workflow.add_node("degraded", self._node("degraded", self.degraded, self.adegraded, answer=True))
+        workflow.add_node("rephrase_question", self._node("rephrase_question", self.rephrase_question, self.arephrase_question))
+        workflow.add_node("check_cache", self._node("check_cache", self.check_cache, self.acheck_cache, answer=True))
+        workflow.add_node("retrieve", self._node("retrieve", self.retrieve, self.aretrieve))
+        workflow.add_node("grade_documents", self._node("grade_documents", self.grade_documents, self.agrade_documents))
+        workflow.add_node(
+            "generate_answer_with_retrieved_documents",
+            self._node(
+                "generate_answer_with_retrieved_documents",
+                self.generate_answer_with_retrieved_documents,
+                self.agenerate_answer_with_retrieved_documents,
+                answer=True,
+            ),
+        )
+        workflow.add_node(
+            "generate_answer_using_all_data",
+            self._node(
+                "generate_answer_using_all_data",
+                self.generate_answer_using_all_data,
+                self.agenerate_answer_using_all_data,
+                answer=True,
+            ),
+        )
         ### build the graph
         workflow.set_entry_point("detect_intent")
         workflow.add_conditional_edges(
@@ -58,10 +341,26 @@ class AssistantGraph:
             {
                 "rag": "rephrase_question",
                 "chat": "chat",
+                "degraded": "degraded",
+            }
+        )
+        workflow.add_edge("rephrase_question", "check_cache")
+        workflow.add_conditional_edges(
+            "check_cache",
+            self.decide_to_use_cache,
+            {
+                "cached": END,
+                "retrieve": "retrieve",
+            }
+        )
+        workflow.add_conditional_edges(
+            "retrieve",
+            self.decide_to_grade,
+            {
+                "grade": "grade_documents",
+                "degraded": "degraded",
             }
         )
-        workflow.add_edge("rephrase_question", "retrieve")
-        workflow.add_edge("retrieve", "grade_documents")
         workflow.add_conditional_edges(
             "grade_documents",
             self.decide_to_use_all_data,
@@ -73,10 +372,33 @@ class AssistantGraph:
         workflow.add_edge("generate_answer_with_retrieved_documents", END)
         workflow.add_edge("generate_answer_using_all_data", END)
         workflow.add_edge("chat", END)
+        workflow.add_edge("degraded", END)
         ### compile the graph
         app = workflow.compile()
         return app
     
+    def _call(self, deadline, fn, **kwargs):
+        """Calls a chain within the per-node timeout and the turn's deadline, raising DeadlineExceeded otherwise"""
+        return call_with_timeout(self._deadline_executor, call_timeout(deadline, self.node_timeout), fn, **kwargs)
+
+    async def _acall(self, deadline, awaitable):
+        """Async counterpart of _call"""
+        return await await_with_timeout(awaitable, call_timeout(deadline, self.node_timeout))
+
+    def _degrade(self, reason):
+        logger.warning("turn degraded: %s", reason)
+        record_degradation(reason)
+
+    def _degraded_state(self, state, reason):
+        """Returns the state routing a turn that ran out of time to the degraded node"""
+        self._degrade(reason)
+        return {"keys": {"message": state["message"], "history": state["history"], "degraded": reason}}
+
+    def _degraded_answer(self, message, reason):
+        """Returns the state of an answering node that ran out of time, answered with the canned response"""
+        self._degrade(reason)
+        return {"keys": {"message": message, "response": self.degraded_response, "degraded": reason}}
+
     # define the nodes
     def detect_intent(self, state):
         """
@@ -91,8 +413,44 @@ class AssistantGraph:
         state = state["keys"]
         message = state["message"]
         history = state["history"]
-        intent = self.intent_detector.run(message=message, history=history)
-        return {"keys": {"message": message, "intent": intent, "history": history}}
+        deadline = state.get(DEADLINE_KEY)
+        if not self.speculative:
+            try:
+                intent = self._call(deadline, self.intent_detector.run, message=message, history=history)
+            except DeadlineExceeded:
+                return self._degraded_state(state, "intent_timeout")
+            return {"keys": {"message": message, "intent": intent, "history": history}}
+        # run in a copy of the current context, so the speculative calls count towards this turn's metrics
+        speculation = self._speculation_executor.submit(contextvars.copy_context().run, self._speculate, message, history)
+        try:
+            intent = self._call(deadline, self.intent_detector.run, message=message, history=history)
+        except DeadlineExceeded:
+            speculation.cancel()
+            return self._degraded_state(state, "intent_timeout")
+        if intent != "sajal_question":
+            # discard the speculative work, it only stops if it has not started yet
+            speculation.cancel()
+            return {"keys": {"message": message, "intent": intent, "history": history}}
+        try:
+            speculated = speculation.result(timeout=call_timeout(deadline, self.node_timeout))
+        except (FutureTimeoutError, DeadlineExceeded):
+            # leave the rephrasing to rephrase_question, which falls back to the message when out of time, the
+            # speculative rephrase itself raises DeadlineExceeded when it outlasts the node timeout
+            speculated = {}
+        return {"keys": {"message": message, "intent": intent, "history": history, **speculated}}
+
+    def _rephrase(self, message, history, deadline=None):
+        """Returns the standalone question, skipping the LLM when there is no history to rephrase against"""
+        if self.skip_rephrase_without_history and not history:
+            return message
+        return self._call(deadline, self.rephrase_question_chain.run, message=message, history=history)
+
+    def _speculate(self, message, history):
+        """Runs the RAG branch's rephrasing, and optionally its retrieval, ahead of the routing decision"""
+        result = {"standalone_question": self._rephrase(message, history)}
+        if self.speculative_retrieve:
+            result["documents"] = self.retriever.run(query=result["standalone_question"])
+        return result
     
     def chat(self, state):
         """
@@ -107,8 +465,24 @@ class AssistantGraph:
         state = state["keys"]
         input = state["message"]
         history = state["history"]
-        response = self.smalltalk.run(message=input, history=history)
+        try:
+            response = self._call(state.get(DEADLINE_KEY), self.smalltalk.run, message=input, history=history)
+        except DeadlineExceeded:
+            return self._degraded_answer(input, "chat_timeout")
         return {"keys": {"message": input, "history": history, "response": response}}
+
+    def degraded(self, state):
+        """
+        Answers with the canned response, for a turn that ran out of time before reaching an answering node
+
+        Args:
+            state (dict): The current graph state
+
+        Returns:
+            str: Updated graph state after adding response
+        """
+        state = state["keys"]
+        return {"keys": {"message": state["message"], "response": self.degraded_response, "degraded": state["degraded"]}}
     
     def grade_documents(self, state):
         """
@@ -121,31 +495,129 @@ class AssistantGraph:
             state (dict): Updates documents key with relevant documents
         """
 
-        print("---CHECK RELEVANCE---")
+        logger.debug("grading the retrieved documents")
         state = state["keys"]
         question = state["standalone_question"]
         documents = state["documents"]
+        deadline = state.get(DEADLINE_KEY)
+
+        grades = self._grade_by_similarity(documents)
+        ambiguous, degraded = self._documents_to_grade(grades, deadline)
+        llm_grades = []
+        if ambiguous:
+            try:
+                # Score the remaining documents concurrently, grades come back in document order
+                llm_grades, failures = self._call(
+                    deadline,
+                    self.document_grader.run_many,
+                    question=question,
+                    contexts=[documents[i].page_content for i in ambiguous],
+                    max_concurrency=self.grading_max_concurrency,
+                    max_relevant=self._remaining_relevant(grades),
+                    with_failures=True,
+                )
+                degraded = self._grading_failed(failures, degraded)
+            except DeadlineExceeded:
+                # answer from the retrieved documents as they are
+                degraded = "grading_timeout"
+                self._degrade(degraded)
+                llm_grades = ["yes"] * len(ambiguous)
+        for i, grade in zip(ambiguous, llm_grades):
+            grades[i] = grade
+        return self._filter_graded_documents(question, documents, grades, degraded)
+
+    def _documents_to_grade(self, grades, deadline):
+        """
+        Returns the indices of the documents left to the grader, fewer when the turn's deadline is near
+
+        Without enough time left to grade, the ungraded documents are used as retrieved. With little time left, only the
+        first degraded_max_grader_calls of them are graded and the rest are dropped.
+
+        Args:
+            grades (list): The grades decided by similarity, updated in place for the documents taken off the grader
+            deadline (float): The turn's deadline, None for no deadline
 
-        # Score
+        Returns:
+            tuple: The indices of the documents to grade, and the reason grading was degraded or None
+        """
+        ambiguous = [i for i, grade in enumerate(grades) if grade is None]
+        left = time_left(deadline)
+        if left is None or not ambiguous:
+            return ambiguous, None
+        if left < self.grading_skip_below:
+            self._degrade("grading_skipped")
+            for i in ambiguous:
+                grades[i] = "yes"
+            return [], "grading_skipped"
+        if left < self.grading_cap_below and len(ambiguous) > self.degraded_max_grader_calls:
+            self._degrade("grading_capped")
+            for i in ambiguous[self.degraded_max_grader_calls:]:
+                grades[i] = "no"
+            return ambiguous[:self.degraded_max_grader_calls], "grading_capped"
+        return ambiguous, None
+
+    def _grading_failed(self, failures, degraded):
+        """Returns the reason grading was degraded, 'grading_failed' if any grader call failed and it was not already"""
+        if not failures or degraded is not None:
+            return degraded
+        # the failed documents were dropped, possibly sending the turn to the all data answer
+        self._degrade("grading_failed")
+        return "grading_failed"
+
+    def _remaining_relevant(self, grades):
+        """Returns how many more relevant documents the grader should look for, after those accepted by similarity"""
+        if self.grading_max_relevant is None:
+            return None
+        return max(self.grading_max_relevant - grades.count("yes"), 0)
+
+    def _grade_by_similarity(self, documents):
+        """
+        Grades the documents whose retrieval similarity is clear cut when the grading cascade is enabled
+
+        Args:
+            documents (list): The retrieved documents
+
+        Returns:
+            list: 'yes' or 'no' for each document decided by its similarity, None for the ones left to the grader
+        """
+        grades = [None] * len(documents)
+        if self.grading_cascade:
+            for i, document in enumerate(documents):
+                similarity = document.metadata.get("similarity")
+                if similarity is None:
+                    continue
+                if similarity >= self.grading_accept_threshold:
+                    grades[i] = "yes"
+                elif similarity < self.grading_reject_threshold:
+                    grades[i] = "no"
+        with self._grading_counters_lock:
+            self.grading_counters["accepted"] += grades.count("yes")
+            self.grading_counters["rejected"] += grades.count("no")
+            self.grading_counters["llm_graded"] += grades.count(None)
+        record_grading_decisions(grades)
+        return grades
+
+    def _filter_graded_documents(self, question, documents, grades, degraded=None):
+        """Keeps the documents graded as relevant, opting to use all data when none are, flagging degraded grading"""
         filtered_docs = []
         all_data = False  # Default do not opt to use all data for generation
-        for d in documents:
-            score = self.document_grader.run(question=question, context=d.page_content)
-            grade = score[0].binary_score
+        for d, grade in zip(documents, grades):
             if grade == "yes":
-                print("---GRADE: FOUND RELEVANT DOCUMENT---")
+                logger.debug("found a relevant document")
                 filtered_docs.append(d)
 
         if not filtered_docs:
             all_data = True  # Opt to use all data for generation
 
-        return {
-            "keys": {
-                "documents": filtered_docs,
-                "standalone_question": question,
-                "run_with_all_data": all_data,
-            }
+        keys = {
+            "documents": filtered_docs,
+            "standalone_question": question,
+            "run_with_all_data": all_data,
         }
+        if degraded is not None:
+            # the answer is built from less carefully graded documents, so it is not cached
+            keys["degraded"] = degraded
+        return {"keys": keys}
         
     def rephrase_question(self, state):
         """
@@ -158,11 +630,49 @@ class AssistantGraph:
             str: Updated graph state after adding standalone question
         """
         state = state["keys"]
+        if "standalone_question" in state:
+            # already rephrased speculatively
+            return {"keys": state}
         question = state["message"]
         chat_history = state["history"]
-        result = self.rephrase_question_chain.run(message=question, history=chat_history)
+        try:
+            result = self._rephrase(message=question, history=chat_history, deadline=state.get(DEADLINE_KEY))
+        except DeadlineExceeded:
+            # the message is the cheapest stand-in for the standalone question
+            self._degrade("rephrase_timeout")
+            result = question
         return {"keys": {"message": question, "history": chat_history, "standalone_question": result}}
     
+    def check_cache(self, state):
+        """
+        Looks up a cached response to a similar standalone question
+
+        Args:
+            state (dict): The current graph state
+
+        Returns:
+            state (dict): New key added to state, response, if a cached response was found
+        """
+        state = state["keys"]
+        question = state["standalone_question"]
+        response = None
+        if self.semantic_cache:
+            try:
+                response = self._call(state.get(DEADLINE_KEY), self.semantic_cache.lookup, question=question)
+            except DeadlineExceeded:
+                self._degrade("cache_timeout")
+        return self._cache_lookup_state(state, response)
+
+    def _cache_lookup_state(self, state, response):
+        keys = {"message": state["message"], "history": state["history"], "standalone_question": state["standalone_question"]}
+        if "documents" in state:
+            keys["documents"] = state["documents"]
+        if response is not None:
+            logger.debug("answered from the semantic cache")
+            record_cache_hit("semantic")
+            keys["response"] = response
+        return {"keys": keys}
+
     def retrieve(self, state):
         """
         Retrieve documents
@@ -176,7 +686,14 @@ class AssistantGraph:
         state = state["keys"]
         question = state["standalone_question"]
         chat_history = state["history"]
-        documents = self.retriever.run(query=question)
+        # documents may have been retrieved speculatively
+        if "documents" in state:
+            documents = state["documents"]
+        else:
+            try:
+                documents = self._call(state.get(DEADLINE_KEY), self.retriever.run, query=question)
+            except DeadlineExceeded:
+                return self._degraded_state(state, "retrieve_timeout")
         return {"keys": {"message": state["message"], "history": chat_history, "standalone_question": question, "documents": documents}}
 
     def generate_answer_using_all_data(self, state):
@@ -191,7 +708,12 @@ class AssistantGraph:
         """
         state = state["keys"]
         question = state["standalone_question"]
-        response = self.qa_all_data.run(question=question)
+        try:
+            response = self._call(state.get(DEADLINE_KEY), self.qa_all_data.run, question=question)
+        except DeadlineExceeded:
+            return self._degraded_answer(question, "answer_timeout")
+        if self.semantic_cache and "degraded" not in state:
+            self.semantic_cache.put(question, response)
         return {"keys": {"message": question, "response": response}}
     
     def generate_answer_with_retrieved_documents(self, state):
@@ -207,9 +729,173 @@ class AssistantGraph:
         state = state["keys"]
         question = state["standalone_question"]
         documents = state["documents"]
-        response = self.rag.run(question=question, documents=documents)
+        try:
+            response = self._call(state.get(DEADLINE_KEY), self.rag.run, question=question, documents=documents)
+        except DeadlineExceeded:
+            return self._degraded_answer(question, "answer_timeout")
+        if self.semantic_cache and "degraded" not in state:
+            self.semantic_cache.put(question, response)
         return {"keys": {"message": question, "response": response}}
     
+    # define the async counterparts of the nodes, used by arun
+    async def adetect_intent(self, state):
+        """Async counterpart of detect_intent"""
+        state = state["keys"]
+        message = state["message"]
+        history = state["history"]
+        deadline = state.get(DEADLINE_KEY)
+        if not self.speculative:
+            try:
+                intent = await self._acall(deadline, self.intent_detector.arun(message=message, history=history))
+            except DeadlineExceeded:
+                return self._degraded_state(state, "intent_timeout")
+            return {"keys": {"message": message, "intent": intent, "history": history}}
+        speculation = asyncio.ensure_future(self._aspeculate(message, history))
+        try:
+            intent = await self._acall(deadline, self.intent_detector.arun(message=message, history=history))
+        except DeadlineExceeded:
+            speculation.cancel()
+            return self._degraded_state(state, "intent_timeout")
+        except BaseException:
+            speculation.cancel()
+            raise
+        if intent != "sajal_question":
+            speculation.cancel()
+            return {"keys": {"message": message, "intent": intent, "history": history}}
+        try:
+            speculated = await self._acall(deadline, speculation)
+        except DeadlineExceeded:
+            speculated = {}
+        return {"keys": {"message": message, "intent": intent, "history": history, **speculated}}
+
+    async def _arephrase(self, message, history, deadline=None):
+        """Async counterpart of _rephrase"""
+        if self.skip_rephrase_without_history and not history:
+            return message
+        return await self._acall(deadline, self.rephrase_question_chain.arun(message=message, history=history))
+
+    async def _aspeculate(self, message, history):
+        """Async counterpart of _speculate"""
+        result = {"standalone_question": await self._arephrase(message, history)}
+        if self.speculative_retrieve:
+            result["documents"] = await self.retriever.arun(query=result["standalone_question"])
+        return result
+
+    async def achat(self, state, config=None):
+        """Async counterpart of chat, forwards the run config so the response tokens can be streamed"""
+        state = state["keys"]
+        input = state["message"]
+        history = state["history"]
+        try:
+            response = await self._acall(
+                state.get(DEADLINE_KEY), self.smalltalk.arun(message=input, history=history, config=config)
+            )
+        except DeadlineExceeded:
+            return self._degraded_answer(input, "chat_timeout")
+        return {"keys": {"message": input, "history": history, "response": response}}
+
+    async def adegraded(self, state):
+        """Async counterpart of degraded"""
+        return self.degraded(state)
+
+    async def agrade_documents(self, state):
+        """Async counterpart of grade_documents"""
+        logger.debug("grading the retrieved documents")
+        state = state["keys"]
+        question = state["standalone_question"]
+        documents = state["documents"]
+        deadline = state.get(DEADLINE_KEY)
+        grades = self._grade_by_similarity(documents)
+        ambiguous, degraded = self._documents_to_grade(grades, deadline)
+        llm_grades = []
+        if ambiguous:
+            try:
+                llm_grades, failures = await self._acall(
+                    deadline,
+                    self.document_grader.arun_many(
+                        question=question,
+                        contexts=[documents[i].page_content for i in ambiguous],
+                        max_concurrency=self.grading_max_concurrency,
+                        max_relevant=self._remaining_relevant(grades),
+                        with_failures=True,
+                    ),
+                )
+                degraded = self._grading_failed(failures, degraded)
+            except DeadlineExceeded:
+                degraded = "grading_timeout"
+                self._degrade(degraded)
+                llm_grades = ["yes"] * len(ambiguous)
+        for i, grade in zip(ambiguous, llm_grades):
+            grades[i] = grade
+        return self._filter_graded_documents(question, documents, grades, degraded)
+
+    async def arephrase_question(self, state):
+        """Async counterpart of rephrase_question"""
+        state = state["keys"]
+        if "standalone_question" in state:
+            return {"keys": state}
+        question = state["message"]
+        chat_history = state["history"]
+        try:
+            result = await self._arephrase(message=question, history=chat_history, deadline=state.get(DEADLINE_KEY))
+        except DeadlineExceeded:
+            self._degrade("rephrase_timeout")
+            result = question
+        return {"keys": {"message": question, "history": chat_history, "standalone_question": result}}
+
+    async def acheck_cache(self, state):
+        """Async counterpart of check_cache"""
+        state = state["keys"]
+        question = state["standalone_question"]
+        response = None
+        if self.semantic_cache:
+            try:
+                response = await self._acall(state.get(DEADLINE_KEY), self.semantic_cache.alookup(question))
+            except DeadlineExceeded:
+                self._degrade("cache_timeout")
+        return self._cache_lookup_state(state, response)
+
+    async def aretrieve(self, state):
+        """Async counterpart of retrieve"""
+        state = state["keys"]
+        question = state["standalone_question"]
+        chat_history = state["history"]
+        if "documents" in state:
+            documents = state["documents"]
+        else:
+            try:
+                documents = await self._acall(state.get(DEADLINE_KEY), self.retriever.arun(query=question))
+            except DeadlineExceeded:
+                return self._degraded_state(state, "retrieve_timeout")
+        return {"keys": {"message": state["message"], "history": chat_history, "standalone_question": question, "documents": documents}}
+
+    async def agenerate_answer_using_all_data(self, state, config=None):
+        """Async counterpart of generate_answer_using_all_data, forwards the run config so the response tokens can be streamed"""
+        state = state["keys"]
+        question = state["standalone_question"]
+        try:
+            response = await self._acall(state.get(DEADLINE_KEY), self.qa_all_data.arun(question=question, config=config))
+        except DeadlineExceeded:
+            return self._degraded_answer(question, "answer_timeout")
+        if self.semantic_cache and "degraded" not in state:
+            await self.semantic_cache.aput(question, response)
+        return {"keys": {"message": question, "response": response}}
+
+    async def agenerate_answer_with_retrieved_documents(self, state, config=None):
+        """Async counterpart of generate_answer_with_retrieved_documents, forwards the run config so the response tokens can be streamed"""
+        state = state["keys"]
+        question = state["standalone_question"]
+        documents = state["documents"]
+        try:
+            response = await self._acall(
+                state.get(DEADLINE_KEY), self.rag.arun(question=question, documents=documents, config=config)
+            )
+        except DeadlineExceeded:
+            return self._degraded_answer(question, "answer_timeout")
+        if self.semantic_cache and "degraded" not in state:
+            await self.semantic_cache.aput(question, response)
+        return {"keys": {"message": question, "response": response}}
+
     # define the edges
     def decide_to_rag(self, state):
         """
@@ -222,11 +908,47 @@ class AssistantGraph:
             str: Next node to call
         """
         state = state["keys"]
+        if "degraded" in state:
+            record_route("degraded")
+            return "degraded"
         intent = state["intent"]
         if intent == "sajal_question":
             return "rag"
+        record_route("chat")
         return "chat"
 
+    def decide_to_grade(self, state):
+        """
+        Decides whether to grade the retrieved documents, or to answer with the canned response if retrieval ran out of time
+
+        Args:
+            state (dict): The current graph state
+
+        Returns:
+            str: Next node to call
+        """
+        state = state["keys"]
+        if "degraded" in state:
+            record_route("degraded")
+            return "degraded"
+        return "grade"
+
+    def decide_to_use_cache(self, state):
+        """
+        Decides whether to end with a cached response or to retrieve documents
+
+        Args:
+            state (dict): The current graph state
+
+        Returns:
+            str: Next node to call
+        """
+        state = state["keys"]
+        if "response" in state:
+            record_route("cached")
+            return "cached"
+        return "retrieve"
+
     def decide_to_use_all_data(self, state):
         """
         Determines whether to use all data for generation or not.
@@ -242,6 +964,8 @@ class AssistantGraph:
         run_with_all_data = state["run_with_all_data"]
 
         if run_with_all_data:
+            record_route("generate_answer_using_all_data")
             return "generate_answer_using_all_data"
         else:
+            record_route("rag")
             return "rag"
@@ -1,20 +1,33 @@
 """Script to ingest data to a ChromaDB vector store, and persist it to disk"""
 
+import argparse
+import hashlib
+import json
 import os
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 from langchain.text_splitter import MarkdownHeaderTextSplitter
 from langchain_community.vectorstores import Chroma
 from langchain_openai import OpenAIEmbeddings
 
+from bm25 import BM25Index
+from context_packing import TOKEN_COUNT_KEY, count_tokens
+from vector_index import write_vector_index
+
 # load the environment variables
 load_dotenv()
 
-# load the data
-markdown_path = "data/source.md"
-# read the markdown file and return the full document as a string
-with open(markdown_path, "r") as file:
-    full_markdown_document = file.read()
+SOURCE_DATA_PATH = "data/source.md"
+VECTOR_DB_PATH = "data/chroma_db"
+MANIFEST_PATH = "data/manifest.json"
+VECTOR_INDEX_PATH = "data/vector_index"
+BM25_INDEX_PATH = "data/bm25_index.json"
+SECTIONS_PATH = "data/sections.json"
+CHECKPOINT_PATH = "data/ingest_checkpoint.jsonl"
 
 # split the data into chunks based on the markdown heading
 headers_to_split_on = [
@@ -22,9 +35,357 @@ headers_to_split_on = [
     ("##", "Header 2"),
     ("###", "Header 3"),
 ]
-markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=headers_to_split_on, strip_headers=False)
-chunked_documents = markdown_splitter.split_text(full_markdown_document)
 
-# create a vector store
-embeddings_model = OpenAIEmbeddings()
-db = Chroma.from_documents(chunked_documents, embeddings_model, persist_directory="data/chroma_db")
+
+def load_chunks(markdown_path):
+    """Reads the markdown file and splits it into chunks based on the markdown headings, with their token counts"""
+    with open(markdown_path, "r") as file:
+        full_markdown_document = file.read()
+    markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=headers_to_split_on, strip_headers=False)
+    chunks = markdown_splitter.split_text(full_markdown_document)
+    # count the tokens once here, so prompts can be packed to a token budget without counting per request
+    for chunk in chunks:
+        chunk.metadata[TOKEN_COUNT_KEY] = count_tokens(chunk.page_content, os.getenv("OPENAI_MODEL"))
+    return chunks
+
+
+def write_sections(sections_path, documents):
+    """Writes the chunks in document order, used to pack the all data context to a token budget"""
+    with open(sections_path, "w") as file:
+        json.dump([{"page_content": d.page_content, "metadata": d.metadata} for d in documents], file)
+
+
+def chunk_id(document):
+    """Returns the content hash of a chunk, used as its document id"""
+    # the token count depends on the tokenizer available, not on the chunk, so a tokenizer change re-embeds nothing
+    metadata = {key: value for key, value in document.metadata.items() if key != TOKEN_COUNT_KEY}
+    content = json.dumps({"page_content": document.page_content, "metadata": metadata}, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def corpus_version(ids):
+    """Returns a hash identifying the set of chunks in the corpus"""
+    return hashlib.sha256("\n".join(sorted(ids)).encode()).hexdigest()
+
+
+def check_mode(manifest_path, mode, rebuild):
+    """
+    Refuses to ingest in another mode than the one that built the store, unless it is rebuilt
+
+    Both modes write the same collection and manifest, and each deletes the stored chunks it does not know of, so a
+    single file ingestion would delete a directory corpus, and a directory ingestion would keep the file's chunks.
+
+    Raises:
+        ValueError: If the manifest records the other mode and rebuild is False
+    """
+    if rebuild or not os.path.exists(manifest_path):
+        return
+    with open(manifest_path) as file:
+        # manifests written before directory ingestion existed are single file ones
+        stored_mode = json.load(file).get("mode", "file")
+    if stored_mode != mode:
+        raise ValueError(
+            f"The vector store was built by {stored_mode} ingestion, pass rebuild=True (--rebuild) to replace it with a "
+            f"{mode} ingestion"
+        )
+
+
+def write_manifest(manifest_path, ids, source_path, mode="file"):
+    manifest = {
+        "corpus_version": corpus_version(ids),
+        "mode": mode,
+        "source": source_path,
+        "chunk_ids": sorted(ids),
+        "ingested_at": time.time(),
+    }
+    # replace the manifest atomically, the serving workers read it to detect re-ingestion
+    with open(manifest_path + ".tmp", "w") as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return manifest
+
+
+def export_vector_index(db, index_path):
+    """Writes the stored chunks and their embeddings to the memory-mapped vector index, without embedding again"""
+    stored = db.get(include=["embeddings", "documents", "metadatas"])
+    write_vector_index(index_path, texts=stored["documents"], metadatas=stored["metadatas"], embeddings=stored["embeddings"])
+
+
+def ingest(
+    source_path=SOURCE_DATA_PATH,
+    vector_db_path=VECTOR_DB_PATH,
+    manifest_path=MANIFEST_PATH,
+    vector_index_path=VECTOR_INDEX_PATH,
+    bm25_index_path=BM25_INDEX_PATH,
+    sections_path=SECTIONS_PATH,
+    rebuild=False,
+    embeddings_model=None,
+):
+    """
+    Ingests the source data into the vector store, only embedding new or changed chunks
+
+    Args:
+        source_path (str): The markdown file to ingest
+        vector_db_path (str): The persist directory of the vector store
+        manifest_path (str): Where to record the ingested chunk ids and corpus version
+        vector_index_path (str): The directory of the memory-mapped vector index used by the numpy retriever backend
+        bm25_index_path (str): Where to write the BM25 inverted index used by hybrid retrieval
+        sections_path (str): Where to write the chunks with their token counts, used by the all data answer
+        rebuild (bool): Delete every stored chunk and embed the whole corpus again, required to replace a corpus
+            ingested by ingest_directory
+        embeddings_model: The model embedding the chunks, defaults to OpenAIEmbeddings
+
+    Returns:
+        dict: The written manifest
+
+    Raises:
+        ValueError: If the store was built by ingest_directory and rebuild is False
+    """
+    check_mode(manifest_path, "file", rebuild)
+    # identical chunks share an id, so keep one of each
+    documents = {chunk_id(document): document for document in load_chunks(source_path)}
+    embeddings_model = embeddings_model or OpenAIEmbeddings()
+    db = Chroma(persist_directory=vector_db_path, embedding_function=embeddings_model)
+    stored_ids = set(db.get(include=[])["ids"])
+    if rebuild and stored_ids:
+        db.delete(ids=list(stored_ids))
+        stored_ids = set()
+
+    new_ids = [id for id in documents if id not in stored_ids]
+    removed_ids = [id for id in stored_ids if id not in documents]
+    if removed_ids:
+        db.delete(ids=removed_ids)
+    if new_ids:
+        db.add_documents([documents[id] for id in new_ids], ids=new_ids)
+    print(f"Ingested {len(new_ids)} new chunks, removed {len(removed_ids)}, kept {len(documents) - len(new_ids)} unchanged")
+    if new_ids or removed_ids or not os.path.exists(vector_index_path):
+        export_vector_index(db, vector_index_path)
+    if new_ids or removed_ids or not os.path.exists(bm25_index_path):
+        BM25Index.build(list(documents.values())).save(bm25_index_path)
+    write_sections(sections_path, documents.values())
+    return write_manifest(manifest_path, list(documents), source_path)
+
+
+def iter_markdown_files(source_dir):
+    """Yields the path of every markdown file under a directory, in a stable order"""
+    for root, dirs, files in os.walk(source_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(".md"):
+                yield os.path.join(root, name)
+
+
+def split_markdown(text, source, model=None):
+    """Splits a markdown document into chunks based on the markdown headings, tagged with their source and token counts"""
+    markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=headers_to_split_on, strip_headers=False)
+    chunks = markdown_splitter.split_text(text)
+    for chunk in chunks:
+        chunk.metadata["source"] = source
+        chunk.metadata[TOKEN_COUNT_KEY] = count_tokens(chunk.page_content, model)
+    return chunks
+
+
+def load_checkpoint(checkpoint_path):
+    """Returns the content hash of every ingested file, None for a file whose ingestion was started but not finished"""
+    files = {}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as file:
+            for line in file:
+                entry = json.loads(line)
+                if entry.get("deleted"):
+                    files.pop(entry["path"], None)
+                else:
+                    files[entry["path"]] = entry["sha256"]
+    return files
+
+
+def write_checkpoint(checkpoint_path, files):
+    """Rewrites the checkpoint with one line per ingested file"""
+    with open(checkpoint_path, "w") as file:
+        for path, sha256 in sorted(files.items()):
+            file.write(json.dumps({"path": path, "sha256": sha256}) + "\n")
+
+
+def embed_with_retry(embeddings_model, texts, max_retries=5, base_delay=1.0, max_delay=60.0):
+    """Embeds a batch of texts, retrying failed calls with exponential backoff and jitter"""
+    for attempt in range(max_retries + 1):
+        try:
+            return embeddings_model.embed_documents(texts)
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            delay = min(base_delay * 2 ** attempt, max_delay) + random.uniform(0, base_delay)
+            print(f"Embedding batch failed ({e!r}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def ingest_directory(
+    source_dir,
+    vector_db_path=VECTOR_DB_PATH,
+    manifest_path=MANIFEST_PATH,
+    checkpoint_path=CHECKPOINT_PATH,
+    batch_size=64,
+    max_concurrency=4,
+    max_retries=5,
+    rebuild=False,
+    embeddings_model=None,
+):
+    """
+    Streams a directory of markdown files into the vector store, holding only a few batches of chunks at a time
+
+    Files are split one at a time and their chunks embedded in batches, up to max_concurrency batches at once. The
+    batches are written to the store in order, and each file is appended to the checkpoint once all its chunks are
+    written, so an interrupted run resumes from the first unfinished file. Unchanged files are skipped, the chunks of
+    changed and deleted files are removed from the store.
+
+    Args:
+        source_dir (str): The directory of markdown files to ingest
+        vector_db_path (str): The persist directory of the vector store
+        manifest_path (str): Where to record the ingested chunk ids and corpus version
+        checkpoint_path (str): The JSON lines file recording the content hash of every ingested file
+        batch_size (int): Number of chunks embedded in one call and written to the store at once
+        max_concurrency (int): Maximum number of embedding calls in flight
+        max_retries (int): Number of times a failed embedding call is retried
+        rebuild (bool): Delete every stored chunk and the checkpoint, and embed the whole corpus again, required to
+            replace a corpus ingested by ingest
+        embeddings_model: The model embedding the chunks, defaults to OpenAIEmbeddings
+
+    Returns:
+        dict: The number of files and chunks ingested, skipped and removed, and the throughput in chunks/sec
+
+    Raises:
+        ValueError: If the store was built by ingest and rebuild is False
+    """
+    check_mode(manifest_path, "directory", rebuild)
+    embeddings_model = embeddings_model or OpenAIEmbeddings()
+    collection = Chroma(persist_directory=vector_db_path, embedding_function=embeddings_model)._collection
+    model = os.getenv("OPENAI_MODEL")
+    if rebuild:
+        stored_ids = collection.get(include=[])["ids"]
+        if stored_ids:
+            collection.delete(ids=stored_ids)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+    ingested = load_checkpoint(checkpoint_path)
+    seen = set()
+    stats = {"files": 0, "skipped_files": 0, "removed_files": 0, "batches": 0, "chunks": 0, "stored_chunks": 0}
+    start = time.perf_counter()
+
+    def checkpoint(path, sha256):
+        with open(checkpoint_path, "a") as file:
+            file.write(json.dumps({"path": path, "sha256": sha256}) + "\n")
+
+    def batches():
+        """Yields the batches of new chunks, with the files whose last chunk is in the batch"""
+        batch, finished = [], []
+        for path in iter_markdown_files(source_dir):
+            source = os.path.relpath(path, source_dir)
+            seen.add(source)
+            with open(path, "r") as file:
+                text = file.read()
+            sha256 = hashlib.sha256(text.encode()).hexdigest()
+            if ingested.get(source) == sha256:
+                stats["skipped_files"] += 1
+                continue
+            if ingested.get(source) is not None:
+                # the file changed, its chunks are replaced
+                collection.delete(where={"source": source})
+            # mark the file as started, so resuming does not delete the chunks written so far
+            checkpoint(source, None)
+            stats["files"] += 1
+            for chunk in split_markdown(text, source, model):
+                # a full batch is only yielded once the next chunk is known, so a file ending it is checkpointed with it
+                if len(batch) == batch_size:
+                    yield batch, finished
+                    batch, finished = [], []
+                batch.append(chunk)
+            finished.append((source, sha256))
+        if batch or finished:
+            yield batch, finished
+
+    def embed(batch):
+        ids = [chunk_id(chunk) for chunk in batch]
+        # chunks written before an interruption are not embedded again
+        stored = set(collection.get(ids=ids, include=[])["ids"])
+        # identical chunks share an id, so keep one of each
+        new = list({id: chunk for id, chunk in zip(ids, batch) if id not in stored}.items())
+        if not new:
+            return new, []
+        return new, embed_with_retry(embeddings_model, [chunk.page_content for _, chunk in new], max_retries=max_retries)
+
+    def write(future, finished, chunks):
+        new, embeddings = future.result()
+        if new:
+            collection.upsert(
+                ids=[id for id, _ in new],
+                embeddings=embeddings,
+                documents=[chunk.page_content for _, chunk in new],
+                metadatas=[chunk.metadata for _, chunk in new],
+            )
+        for source, sha256 in finished:
+            checkpoint(source, sha256)
+        stats["batches"] += 1
+        stats["chunks"] += chunks
+        stats["stored_chunks"] += len(new)
+        if stats["batches"] % 10 == 0:
+            elapsed = time.perf_counter() - start
+            print(f"Ingested {stats['chunks']} chunks from {stats['files']} files, {stats['chunks'] / elapsed:.1f} chunks/sec")
+
+    # batches are written in submission order, so a checkpointed file never has unwritten chunks before it
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        for batch, finished in batches():
+            in_flight.append((executor.submit(embed, batch), finished, len(batch)))
+            if len(in_flight) >= max_concurrency:
+                write(*in_flight.popleft())
+        while in_flight:
+            write(*in_flight.popleft())
+
+    for source in set(ingested) - seen:
+        collection.delete(where={"source": source})
+        stats["removed_files"] += 1
+    write_checkpoint(checkpoint_path, {path: sha256 for path, sha256 in load_checkpoint(checkpoint_path).items() if path in seen})
+    write_manifest(manifest_path, collection.get(include=[])["ids"], source_dir, mode="directory")
+
+    stats["seconds"] = round(time.perf_counter() - start, 3)
+    stats["chunks_per_second"] = round(stats["chunks"] / stats["seconds"], 2) if stats["seconds"] else 0.0
+    print(json.dumps(stats))
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--source", default=SOURCE_DATA_PATH, help="markdown file to ingest")
+    parser.add_argument("--source-dir", default=None, help="directory of markdown files to stream into the vector store instead")
+    parser.add_argument("--vector-db", default=VECTOR_DB_PATH, help="persist directory of the vector store")
+    parser.add_argument("--manifest", default=MANIFEST_PATH, help="path of the ingestion manifest")
+    parser.add_argument("--vector-index", default=VECTOR_INDEX_PATH, help="directory of the memory-mapped vector index")
+    parser.add_argument("--bm25-index", default=BM25_INDEX_PATH, help="path of the BM25 inverted index")
+    parser.add_argument("--sections", default=SECTIONS_PATH, help="path of the chunks with their token counts")
+    parser.add_argument("--rebuild", action="store_true", help="re-embed the whole corpus instead of only the changes")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH, help="progress file of --source-dir ingestion")
+    parser.add_argument("--batch-size", type=int, default=64, help="chunks per embedding call with --source-dir")
+    parser.add_argument("--max-concurrency", type=int, default=4, help="embedding calls in flight with --source-dir")
+    parser.add_argument("--max-retries", type=int, default=5, help="retries of a failed embedding call with --source-dir")
+    args = parser.parse_args()
+    if args.source_dir:
+        ingest_directory(
+            source_dir=args.source_dir,
+            vector_db_path=args.vector_db,
+            manifest_path=args.manifest,
+            checkpoint_path=args.checkpoint,
+            batch_size=args.batch_size,
+            max_concurrency=args.max_concurrency,
+            max_retries=args.max_retries,
+            rebuild=args.rebuild,
+        )
+    else:
+        ingest(
+            source_path=args.source,
+            vector_db_path=args.vector_db,
+            manifest_path=args.manifest,
+            vector_index_path=args.vector_index,
+            bm25_index_path=args.bm25_index,
+            sections_path=args.sections,
+            rebuild=args.rebuild,
+        )
@@ -0,0 +1,164 @@
+"""Implements the IntentRouter class, a local fast path in front of the intent detection chain"""
+
+import json
+import re
+import threading
+
+import numpy as np
+
+from metrics import record_intent_decision
+from vector_index import normalize_rows
+
+# labelled examples for the local classifier, the same labels as the intent detection chain
+DEFAULT_INTENT_EXAMPLES = {
+    "smalltalk": [
+        "hi",
+        "hello",
+        "hey",
+        "hey there",
+        "good morning",
+        "good evening",
+        "how are you",
+        "how are you doing",
+        "what's up",
+        "thanks",
+        "thank you",
+        "thanks a lot",
+        "ok",
+        "okay",
+        "cool",
+        "great",
+        "bye",
+        "goodbye",
+        "see you",
+        "who are you",
+        "what can you do",
+        "tell me a joke",
+        "what's the weather like today",
+        "who is the president of the united states",
+    ],
+    "sajal_question": [
+        "where does sajal work",
+        "where does he work",
+        "what is sajal's current job",
+        "how can i contact sajal",
+        "what is his email",
+        "what is sajal's phone number",
+        "what is his linkedin",
+        "what is sajal's github",
+        "what is sajal's work experience",
+        "where did sajal study",
+        "what is his educational background",
+        "what certifications does sajal have",
+        "what are sajal's hobbies",
+        "what are his skills",
+        "tell me about sajal",
+        "who is sajal sharma",
+        "what projects has sajal worked on",
+        "how many years of experience does sajal have",
+    ],
+}
+
+
+def normalize_message(message):
+    """Returns the message lowercased, without punctuation and with its whitespace collapsed"""
+    return re.sub(r"\s+", " ", re.sub(r"[^\w\s']", " ", message.lower())).strip()
+
+
+class IntentRouter:
+    """
+    Detects intents with a cheap local classifier, only sending ambiguous messages to the intent detection chain.
+
+    The first tier looks up the normalized message among the labelled examples. The second tier embeds the message
+    and picks the nearest label centroid, if it is both similar enough and ahead of the other labels by a margin. It
+    only decides the first message of a conversation, as it cannot tell what a follow-up like "tell me more" refers
+    to. Anything else goes to the LLM tier, which sees the history.
+    """
+
+    def __init__(self, intent_detector, embedding_model, examples=None, min_similarity=0.85, min_margin=0.05):
+        """
+        Args:
+            intent_detector: The intent detection chain used for ambiguous messages
+            embedding_model: The model used to embed the messages and the labelled examples
+            examples (dict | str): Labelled examples per intent, or the path of a JSON file with them
+            min_similarity (float): Minimum cosine similarity to the nearest centroid to decide locally
+            min_margin (float): Minimum similarity lead of the nearest centroid over the next one to decide locally
+        """
+        if isinstance(examples, str):
+            with open(examples, "r") as file:
+                examples = json.load(file)
+        self.intent_detector = intent_detector
+        self.embedding_model = embedding_model
+        self.examples = examples or DEFAULT_INTENT_EXAMPLES
+        self.min_similarity = min_similarity
+        self.min_margin = min_margin
+        self.phrases = {normalize_message(text): label for label, texts in self.examples.items() for text in texts}
+        self.counters = {"phrase": 0, "centroid": 0, "llm": 0}
+        self._labels = list(self.examples)
+        self._centroids = None
+        self._lock = threading.Lock()
+
+    def _set_centroids(self, embeddings):
+        """Computes the normalized centroid of each label from the embeddings of its examples"""
+        centroids, start = [], 0
+        for label in self._labels:
+            count = len(self.examples[label])
+            centroids.append(normalize_rows(embeddings[start:start + count]).mean(axis=0))
+            start += count
+        self._centroids = normalize_rows(centroids)
+
+    def _example_texts(self):
+        return [text for label in self._labels for text in self.examples[label]]
+
+    def _classify(self, embedding):
+        """Returns the nearest label if it is a confident match, otherwise None"""
+        similarities = self._centroids @ normalize_rows(embedding)
+        order = np.argsort(-similarities)
+        best = similarities[order[0]]
+        runner_up = similarities[order[1]] if len(order) > 1 else -1.0
+        if best >= self.min_similarity and best - runner_up >= self.min_margin:
+            return self._labels[order[0]]
+        return None
+
+    def _count(self, tier):
+        with self._lock:
+            self.counters[tier] += 1
+        record_intent_decision(tier)
+
+    def run(self, message, history):
+        """Returns the detected intent"""
+        intent = self.phrases.get(normalize_message(message))
+        if intent is not None:
+            self._count("phrase")
+            return intent
+        if not history:
+            if self._centroids is None:
+                # the examples are embedded on first use, and cached by the embedding model after that
+                self._set_centroids(self.embedding_model.embed_documents(self._example_texts()))
+            intent = self._classify(self.embedding_model.embed_query(message))
+        if intent is not None:
+            self._count("centroid")
+            return intent
+        self._count("llm")
+        return self.intent_detector.run(message=message, history=history)
+
+    async def arun(self, message, history):
+        """Asynchronously returns the detected intent"""
+        intent = self.phrases.get(normalize_message(message))
+        if intent is not None:
+            self._count("phrase")
+            return intent
+        if not history:
+            if self._centroids is None:
+                self._set_centroids(await self.embedding_model.aembed_documents(self._example_texts()))
+            intent = self._classify(await self.embedding_model.aembed_query(message))
+        if intent is not None:
+            self._count("centroid")
+            return intent
+        self._count("llm")
+        return await self.intent_detector.arun(message=message, history=history)
+
+    def stats(self):
+        """Returns how many messages each tier decided, and how many LLM calls the local tiers avoided"""
+        with self._lock:
+            return {**self.counters, "llm_calls_avoided": self.counters["phrase"] + self.counters["centroid"]}
@@ -0,0 +1,188 @@
+"""Implements the ConversationMemory class, bounding the chat history sent to the chains"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from context_packing import count_tokens
+
+logger = logging.getLogger(__name__)
+
+
+def process_history(turns):
+    """Return the history as a list of HumanMessage and AIMessage tuples"""
+    chat_history = []
+    for pair in turns:
+        human_message, ai_message = pair
+        chat_history.append(HumanMessage(content=human_message))
+        chat_history.append(AIMessage(content=ai_message))
+    return chat_history
+
+
+def format_turns(turns):
+    return "\n".join(f"User: {human_message}\nSaj: {ai_message}" for human_message, ai_message in turns)
+
+
+class ConversationMemory:
+    """
+    Keeps the last turns of a conversation verbatim and folds the older ones into a rolling summary.
+
+    Summaries are keyed on a chained hash of the turns they cover, so no session id is needed: the summary for the
+    next turn extends the cached summary of the turns before it with a single summarizer call. prefetch computes it
+    in the background once a response is sent, keeping the summarizer off the critical path of the next turn. When the
+    summarizer fails, the view falls back to the latest cached summary and keeps the turns it does not cover verbatim.
+    """
+
+    def __init__(self, summarizer, max_turns=4, token_budget=1500, max_summaries=1024, model=None):
+        """
+        Args:
+            summarizer: The chain folding turns into the summary
+            max_turns (int): Number of most recent turns kept verbatim
+            token_budget (int): Maximum number of tokens of the history view, the oldest verbatim turns are dropped first
+            max_summaries (int): Maximum number of cached summaries, least recently used are evicted first
+            model (str): The model the tokens are counted for
+        """
+        self.summarizer = summarizer
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.max_summaries = max_summaries
+        self.model = model
+        self._summaries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _prefix_keys(turns):
+        """Returns the key of every prefix of the turns, each chained from the key of the prefix before it"""
+        keys, key = [], ""
+        for turn in turns:
+            key = hashlib.sha256((key + json.dumps(list(turn))).encode()).hexdigest()
+            keys.append(key)
+        return keys
+
+    def _cached(self, key):
+        with self._lock:
+            if key in self._summaries:
+                self._summaries.move_to_end(key)
+                return self._summaries[key]
+            return None
+
+    def _store(self, key, summary):
+        with self._lock:
+            self._summaries[key] = summary
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > self.max_summaries:
+                self._summaries.popitem(last=False)
+
+    def _latest_cached(self, keys):
+        """Returns the number of turns covered by the longest cached summary, and that summary"""
+        for covered in range(len(keys), 0, -1):
+            summary = self._cached(keys[covered - 1])
+            if summary is not None:
+                return covered, summary
+        return 0, ""
+
+    def _split(self, turns):
+        turns = [tuple(turn) for turn in turns]
+        if len(turns) <= self.max_turns:
+            return [], turns
+        return turns[:-self.max_turns], turns[-self.max_turns:]
+
+    def _messages(self, summary, recent):
+        """Returns the history view, dropping the oldest verbatim turns until it fits the token budget"""
+        summary_messages = [SystemMessage(content=f"Summary of the earlier conversation: {summary}")] if summary else []
+        while True:
+            messages = summary_messages + process_history(recent)
+            tokens = sum(count_tokens(message.content or "", self.model) for message in messages)
+            if self.token_budget is None or tokens <= self.token_budget or not recent:
+                return messages
+            recent = recent[1:]
+
+    def _summary(self, turns):
+        """
+        Returns the summary of the turns, folding in only the turns not covered by a cached summary
+
+        Returns:
+            tuple: The summary, and the turns it does not cover because the summarizer failed
+        """
+        if not turns:
+            return "", []
+        keys = self._prefix_keys(turns)
+        covered, summary = self._latest_cached(keys)
+        if covered < len(turns):
+            try:
+                summary = self.summarizer.run(summary=summary, new_lines=format_turns(turns[covered:]))
+            except Exception:
+                logger.warning("summarizing the history failed, keeping %d turns verbatim", len(turns) - covered, exc_info=True)
+                return summary, turns[covered:]
+            self._store(keys[-1], summary)
+        return summary, []
+
+    async def _asummary(self, turns):
+        """Async counterpart of _summary, waiting on a prefetch of the same summary if one is in flight"""
+        if not turns:
+            return "", []
+        keys = self._prefix_keys(turns)
+        pending = self._pending.get(keys[-1])
+        if pending is not None:
+            try:
+                return await asyncio.shield(pending)
+            except Exception:
+                pass  # fold the turns here instead
+        return await self._afold(turns, keys)
+
+    async def _afold(self, turns, keys):
+        """Asynchronously folds the turns not covered by a cached summary into it, see _summary"""
+        covered, summary = self._latest_cached(keys)
+        if covered < len(turns):
+            try:
+                summary = await self.summarizer.arun(summary=summary, new_lines=format_turns(turns[covered:]))
+            except Exception:
+                logger.warning("summarizing the history failed, keeping %d turns verbatim", len(turns) - covered, exc_info=True)
+                return summary, turns[covered:]
+            self._store(keys[-1], summary)
+        return summary, []
+
+    def view(self, turns):
+        """
+        Returns the bounded history view of a conversation
+
+        Args:
+            turns (list): The (user message, assistant message) pairs of the conversation so far
+
+        Returns:
+            list: A summary message of the older turns, if any, followed by the messages of the recent turns
+        """
+        older, recent = self._split(turns)
+        summary, unsummarized = self._summary(older)
+        return self._messages(summary, unsummarized + recent)
+
+    async def aview(self, turns):
+        """Async counterpart of view"""
+        older, recent = self._split(turns)
+        summary, unsummarized = await self._asummary(older)
+        return self._messages(summary, unsummarized + recent)
+
+    def prefetch(self, turns):
+        """Starts summarizing the older turns the next view of this conversation will need, from a running event loop"""
+        older, _ = self._split(turns)
+        if not older:
+            return
+        keys = self._prefix_keys(older)
+        key = keys[-1]
+        if key in self._pending or self._cached(key) is not None:
+            return
+        task = asyncio.ensure_future(self._afold(older, keys))
+        self._pending[key] = task
+        task.add_done_callback(lambda task: self._prefetch_done(key, task))
+
+    def _prefetch_done(self, key, task):
+        self._pending.pop(key, None)
+        # a failed prefetch is retried by the next view, retrieve the exception so it is not reported as unhandled
+        if not task.cancelled():
+            task.exception()
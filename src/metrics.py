@@ -0,0 +1,361 @@
+"""Implements per-node latency, token and cost instrumentation, exposed in the Prometheus text format"""
+
+import functools
+import inspect
+import json
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.tracers.context import register_configure_hook
+
+from context_packing import count_tokens
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Counter:
+    """A monotonically increasing Prometheus counter, with optional labels"""
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Gauge:
+    """A Prometheus gauge holding the last value set, with optional labels"""
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def value(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())))
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    """A Prometheus histogram with cumulative buckets, with optional labels"""
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        # labels -> (bucket counts, sum, count)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            counts = [c + (value <= bound) for c, bound in zip(counts, self.buckets)]
+            self._values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_format_labels(key + (('le', bound),))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class Registry:
+    """Holds the metrics rendered by the metrics endpoint"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format"""
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+REQUEST_DURATION = REGISTRY.register(Histogram("assistant_request_duration_seconds", "Wall time of a turn, by route"))
+NODE_DURATION = REGISTRY.register(Histogram("assistant_node_duration_seconds", "Wall time of a graph node, by node"))
+CHAIN_DURATION = REGISTRY.register(Histogram("assistant_chain_duration_seconds", "Wall time of a chain call, by chain"))
+LLM_CALLS_PER_REQUEST = REGISTRY.register(
+    Histogram("assistant_llm_calls_per_request", "LLM calls made by a turn, by route", buckets=COUNT_BUCKETS)
+)
+REQUESTS = REGISTRY.register(Counter("assistant_requests_total", "Turns handled, by route"))
+LLM_CALLS = REGISTRY.register(Counter("assistant_llm_calls_total", "LLM calls made"))
+TOKENS = REGISTRY.register(Counter("assistant_tokens_total", "LLM tokens used, by kind (prompt or completion)"))
+CACHE_HITS = REGISTRY.register(Counter("assistant_cache_hits_total", "Cache hits, by cache"))
+STARTUP_DURATION = REGISTRY.register(
+    Gauge("assistant_startup_seconds", "Wall time of the process startup, by phase (build, warmup, ready, connections, first_request)")
+)
+EMBEDDING_BATCH_SIZE = REGISTRY.register(
+    Histogram("assistant_embedding_batch_size", "Distinct queries embedded per coalesced embedding call", buckets=BATCH_BUCKETS)
+)
+DEGRADATIONS = REGISTRY.register(
+    Counter("assistant_degradations_total", "Cheaper fallbacks taken to meet a turn's deadline, by reason")
+)
+GRADING_DECISIONS = REGISTRY.register(
+    Counter(
+        "assistant_grading_decisions_total",
+        "Retrieved documents graded, by decision (accepted or rejected by similarity, or llm_graded)",
+    )
+)
+INTENT_DECISIONS = REGISTRY.register(
+    Counter("assistant_intent_decisions_total", "Intents detected by the intent router, by tier (phrase, centroid or llm)")
+)
+
+
+class RequestMetrics(BaseCallbackHandler):
+    """
+    Collects the metrics of one turn.
+
+    It is also a callback handler: while a turn is tracked, it is added to every LangChain callback manager, so it
+    sees each LLM call of every chain without the chains having to forward their run config.
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.route = None
+        self.nodes = {}
+        self.chains = {}
+        self.llm_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cache_hits = {}
+        self.degradations = []
+        self._estimated_prompt_tokens = {}
+        self._lock = threading.Lock()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        # streamed responses report no token usage, so keep an estimate of the prompt to fall back on
+        model = (kwargs.get("invocation_params") or {}).get("model")
+        tokens = sum(count_tokens(str(message.content), model) for batch in messages for message in batch)
+        with self._lock:
+            self.llm_calls += 1
+            self._estimated_prompt_tokens[run_id] = tokens
+        LLM_CALLS.inc()
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        with self._lock:
+            estimated_prompt_tokens = self._estimated_prompt_tokens.pop(run_id, 0)
+        prompt_tokens = usage.get("prompt_tokens", estimated_prompt_tokens)
+        completion_tokens = usage.get("completion_tokens")
+        if completion_tokens is None:
+            completion_tokens = sum(count_tokens(g.text) for generations in response.generations for g in generations)
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+        TOKENS.inc(prompt_tokens, kind="prompt")
+        TOKENS.inc(completion_tokens, kind="completion")
+
+    def record_node(self, node, seconds):
+        with self._lock:
+            self.nodes[node] = self.nodes.get(node, 0.0) + seconds
+
+    def record_chain(self, chain, seconds):
+        with self._lock:
+            self.chains[chain] = self.chains.get(chain, 0.0) + seconds
+
+    def record_cache_hit(self, cache):
+        with self._lock:
+            self.cache_hits[cache] = self.cache_hits.get(cache, 0) + 1
+
+    def record_degradation(self, reason):
+        with self._lock:
+            self.degradations.append(reason)
+
+    def record(self):
+        """Returns the collected metrics as a dict"""
+        return {
+            "route": self.route,
+            "duration_seconds": round(time.perf_counter() - self.started_at, 4),
+            "nodes": {node: round(seconds, 4) for node, seconds in self.nodes.items()},
+            "chains": {chain: round(seconds, 4) for chain, seconds in self.chains.items()},
+            "llm_calls": self.llm_calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cache_hits": self.cache_hits,
+            "degradations": self.degradations,
+        }
+
+
+_request_metrics_var = ContextVar("request_metrics", default=None)
+# add the tracked turn's handler to every callback manager configured in its context
+register_configure_hook(_request_metrics_var, True)
+
+
+def start_request():
+    """Starts tracking the metrics of a turn in the current context, returns None if a caller already tracks it"""
+    if current_request() is not None:
+        return None
+    request_metrics = RequestMetrics()
+    _request_metrics_var.set(request_metrics)
+    return request_metrics
+
+
+def finish_request(request_metrics):
+    """Stops tracking the turn, records it in the metrics and logs it as one structured line"""
+    if request_metrics is None:
+        return None
+    _request_metrics_var.set(None)
+    record = request_metrics.record()
+    route = record["route"] or "unknown"
+    REQUEST_DURATION.observe(record["duration_seconds"], route=route)
+    LLM_CALLS_PER_REQUEST.observe(record["llm_calls"], route=route)
+    REQUESTS.inc(route=route)
+    logger.info(json.dumps(record))
+    return record
+
+
+def current_request():
+    """Returns the metrics of the turn tracked in the current context, or None"""
+    return _request_metrics_var.get()
+
+
+def record_route(route):
+    request_metrics = current_request()
+    if request_metrics is not None:
+        request_metrics.route = route
+
+
+def record_cache_hit(cache):
+    CACHE_HITS.inc(cache=cache)
+    request_metrics = current_request()
+    if request_metrics is not None:
+        request_metrics.record_cache_hit(cache)
+
+
+def record_degradation(reason):
+    DEGRADATIONS.inc(reason=reason)
+    request_metrics = current_request()
+    if request_metrics is not None:
+        request_metrics.record_degradation(reason)
+
+
+def record_grading_decisions(grades):
+    """Counts the documents the grading cascade accepted or rejected by similarity, and those left to the grader"""
+    for decision, grade in (("accepted", "yes"), ("rejected", "no"), ("llm_graded", None)):
+        GRADING_DECISIONS.inc(grades.count(grade), decision=decision)
+
+
+def record_intent_decision(tier):
+    INTENT_DECISIONS.inc(tier=tier)
+
+
+def record_embedding_batch(size):
+    EMBEDDING_BATCH_SIZE.observe(size)
+
+
+def record_startup(phase, seconds):
+    STARTUP_DURATION.set(round(seconds, 4), phase=phase)
+    logger.info(json.dumps({"startup_phase": phase, "seconds": round(seconds, 4)}))
+
+
+def _observe(histogram, label, name, seconds):
+    histogram.observe(seconds, **{label: name})
+    request_metrics = current_request()
+    if request_metrics is not None:
+        (request_metrics.record_node if histogram is NODE_DURATION else request_metrics.record_chain)(name, seconds)
+
+
+def _timed(histogram, label, name, fn):
+    """Wraps a sync or async function to observe its wall time"""
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                _observe(histogram, label, name, time.perf_counter() - start)
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _observe(histogram, label, name, time.perf_counter() - start)
+    return wrapper
+
+
+def timed_node(name, fn):
+    """Wraps a graph node to observe its wall time, keeping its signature so a config argument is still passed"""
+    return _timed(NODE_DURATION, "node", name, fn)
+
+
+def instrument(chain):
+    """Decorates a chain method to observe its wall time"""
+    return lambda fn: _timed(CHAIN_DURATION, "chain", chain, fn)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host="0.0.0.0"):
+    """Serves the metrics at /metrics on a background thread"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,113 @@
+"""Implements the ModelRouter class, assigning a chat model and its settings to each stage of the assistant"""
+
+import os
+import threading
+
+import openai
+from langchain_openai import ChatOpenAI
+
+# classification and short rewriting stages, which the faster functions model handles as well as the large one
+FAST_STAGES = ("intent", "rephrase", "grade", "summarize")
+# generation stages, streamed to the chat UI
+GENERATION_STAGES = ("smalltalk", "rag", "all_data")
+STAGES = FAST_STAGES + GENERATION_STAGES
+
+# settings of a stage on top of its model, each a ChatOpenAI argument except timeout
+_DEFAULT_STAGE_SETTINGS = {
+    "intent": {"temperature": 0, "max_tokens": 50, "timeout": 10},
+    "rephrase": {"temperature": 0, "max_tokens": 150, "timeout": 10},
+    "grade": {"temperature": 0, "max_tokens": 50, "timeout": 10},
+    "summarize": {"temperature": 0, "max_tokens": 400, "timeout": 30},
+    "smalltalk": {"temperature": 0, "max_tokens": 500, "timeout": 30, "streaming": True},
+    "rag": {"temperature": 0, "max_tokens": 1000, "timeout": 60, "streaming": True},
+    "all_data": {"temperature": 0, "max_tokens": 1000, "timeout": 60, "streaming": True},
+}
+
+
+def default_model_routes(model=None, functions_model=None):
+    """
+    Returns the default route of every stage
+
+    Args:
+        model (str): The model of the generation stages, defaults to OPENAI_MODEL
+        functions_model (str): The model of the fast stages, defaults to OPENAI_FUNCTIONS_MODEL, then to model
+
+    Returns:
+        dict: The model, temperature, max_tokens, timeout and streaming flag of each stage
+    """
+    model = model or os.getenv("OPENAI_MODEL")
+    functions_model = functions_model or os.getenv("OPENAI_FUNCTIONS_MODEL") or model
+    return {
+        stage: {"model": functions_model if stage in FAST_STAGES else model, **settings}
+        for stage, settings in _DEFAULT_STAGE_SETTINGS.items()
+    }
+
+
+class ModelRouter:
+    """
+    Builds the chat model of each stage from its route.
+
+    All the chat models send their requests through one shared OpenAI client, so they share its connection pool, and
+    stages with identical routes share the same chat model instance.
+    """
+
+    def __init__(self, routes=None, client=None, async_client=None):
+        """
+        Args:
+            routes (dict): Settings per stage overriding the defaults of default_model_routes, e.g.
+                {"rag": {"model": "gpt-4-turbo-preview", "max_tokens": 800}}
+            client (openai.OpenAI): The shared sync client, defaults to one configured from the environment
+            async_client (openai.AsyncOpenAI): The shared async client, defaults to one configured from the environment
+        """
+        unknown = set(routes or {}) - set(STAGES)
+        if unknown:
+            raise ValueError(f"Unknown stages {sorted(unknown)}, expected some of {list(STAGES)}")
+        defaults = default_model_routes()
+        self.routes = {stage: {**defaults[stage], **(routes or {}).get(stage, {})} for stage in STAGES}
+        self._client = client
+        self._async_client = async_client
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def llm(self, stage, **overrides):
+        """
+        Returns the chat model of a stage
+
+        Args:
+            stage (str): One of STAGES
+            **overrides: Settings taking precedence over the stage's route
+
+        Returns:
+            ChatOpenAI: The chat model, shared with every stage of the same settings
+        """
+        route = {**self.routes[stage], **overrides}
+        key = tuple(sorted(route.items()))
+        with self._lock:
+            if key not in self._models:
+                self._models[key] = self._build(route)
+            return self._models[key]
+
+    def _build(self, route):
+        if self._client is None:
+            self._client = openai.OpenAI()
+        if self._async_client is None:
+            self._async_client = openai.AsyncOpenAI()
+        settings = dict(route)
+        timeout = settings.pop("timeout", None)
+        client, async_client = self._client, self._async_client
+        if timeout is not None:
+            # with_options copies the client around the same connection pool
+            client, async_client = client.with_options(timeout=timeout), async_client.with_options(timeout=timeout)
+        return ChatOpenAI(
+            client=client.chat.completions,
+            async_client=async_client.chat.completions,
+            request_timeout=timeout,
+            **settings,
+        )
+
+    def stats(self):
+        """Returns the model of each stage, and how many distinct chat models were built"""
+        return {
+            "models": {stage: route["model"] for stage, route in self.routes.items()},
+            "instances": len(self._models),
+        }
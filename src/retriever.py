@@ -1,16 +1,126 @@
 """Impleemnts the Retriever class for retrieving data from the database"""
 
-from langchain_community.vectorstores import Chroma
+import os
+
+from langchain_core.documents import Document
 from langchain_openai import OpenAIEmbeddings
 
+from bm25 import BM25Index
+from embedding_cache import CachedEmbeddings
+from vector_index import VectorIndex
+
 class Retriever:
     """Retrieves data from the database"""
+
+    BACKENDS = ("chroma", "numpy")
     
-    def __init__(self, vector_db_path):
-        _embedding_model = OpenAIEmbeddings()
-        _db = Chroma(persist_directory=vector_db_path, embedding_function=_embedding_model)
-        self.retriever = _db.as_retriever()
+    def __init__(
+        self,
+        vector_db_path,
+        embedding_cache_path=None,
+        backend="chroma",
+        vector_index_path=None,
+        k=4,
+        hybrid=False,
+        bm25_index_path=None,
+        candidate_k=None,
+        rrf_k=60,
+        vector_weight=1.0,
+        lexical_weight=1.0,
+        embedding_model=None,
+    ):
+        """
+        Args:
+            vector_db_path (str): The persist directory of the vector store
+            embedding_cache_path (str): Path of the SQLite file caching query embeddings, defaults to a file next to the vector store
+            backend (str): "chroma" to search the Chroma store, "numpy" to search the memory-mapped vector index
+            vector_index_path (str): The directory of the memory-mapped vector index, defaults to a directory next to the vector store
+            k (int): Number of documents to retrieve
+            hybrid (bool): Whether to fuse the vector results with BM25 lexical results
+            bm25_index_path (str): The BM25 index written by ingest_data.py, defaults to a file next to the vector store
+            candidate_k (int): Number of candidates taken from each of the vector and lexical searches before fusion, defaults to 2 * k
+            rrf_k (int): Reciprocal rank fusion constant, larger values flatten the difference between ranks
+            vector_weight (float): Weight of the vector ranking in the fusion
+            lexical_weight (float): Weight of the lexical ranking in the fusion
+            embedding_model: The model embedding the queries, defaults to OpenAIEmbeddings
+        """
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown retriever backend {backend!r}, expected one of {self.BACKENDS}")
+        data_dir = os.path.dirname(os.path.normpath(vector_db_path))
+        if embedding_cache_path is None:
+            embedding_cache_path = os.path.join(data_dir, "embedding_cache.sqlite3")
+        if vector_index_path is None:
+            vector_index_path = os.path.join(data_dir, "vector_index")
+        if bm25_index_path is None:
+            bm25_index_path = os.path.join(data_dir, "bm25_index.json")
+        self.backend = backend
+        self.k = k
+        self.hybrid = hybrid
+        self.candidate_k = candidate_k or 2 * k
+        self.rrf_k = rrf_k
+        self.vector_weight = vector_weight
+        self.lexical_weight = lexical_weight
+        # cache the query embeddings, so repeated questions skip the embeddings API
+        self.embedding_model = CachedEmbeddings(embedding_model or OpenAIEmbeddings(), persist_path=embedding_cache_path)
+        self.bm25_index = BM25Index.load(bm25_index_path) if hybrid else None
+        if backend == "numpy":
+            self.index = VectorIndex(vector_index_path)
+        else:
+            # imported here, so the numpy backend never loads the Chroma client
+            from langchain_community.vectorstores import Chroma
+            self.db = Chroma(persist_directory=vector_db_path, embedding_function=self.embedding_model)
+
+    def _to_cosine(self, distance):
+        """Converts a Chroma distance to the cosine similarity of the normalized embeddings"""
+        space = (self.db._collection.metadata or {}).get("hnsw:space", "l2")
+        if space == "l2":
+            # chroma's l2 distance is squared, and equals 2 - 2 * cosine for unit vectors
+            return 1 - distance / 2
+        return 1 - distance
+
+    @staticmethod
+    def _with_similarity(results):
+        """Returns copies of the documents with their cosine similarity to the query in the metadata"""
+        return [
+            Document(page_content=document.page_content, metadata={**document.metadata, "similarity": similarity})
+            for document, similarity in results
+        ]
+
+    def _vector_search(self, query, k):
+        if self.backend == "numpy":
+            return self._with_similarity(self.index.search(self.embedding_model.embed_query(query), k=k))
+        results = self.db.similarity_search_with_score(query, k=k)
+        return self._with_similarity([(document, self._to_cosine(distance)) for document, distance in results])
+
+    async def _avector_search(self, query, k):
+        if self.backend == "numpy":
+            return self._with_similarity(self.index.search(await self.embedding_model.aembed_query(query), k=k))
+        results = await self.db.asimilarity_search_with_score(query, k=k)
+        return self._with_similarity([(document, self._to_cosine(distance)) for document, distance in results])
+
+    def _fuse(self, vector_documents, lexical_documents):
+        """Combines the vector and lexical rankings with weighted reciprocal rank fusion, keeping the top k"""
+        scores, documents = {}, {}
+        for weight, ranking in ((self.vector_weight, vector_documents), (self.lexical_weight, lexical_documents)):
+            for rank, document in enumerate(ranking):
+                # chunks are identified by their content, the same chunk comes back from both searches
+                key = document.page_content
+                documents.setdefault(key, document)
+                scores[key] = scores.get(key, 0.0) + weight / (self.rrf_k + rank + 1)
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        return [documents[key] for key in ranked[:self.k]]
+
+    def _lexical_search(self, query):
+        return [document for document, _ in self.bm25_index.search(query, k=self.candidate_k)]
 
     def run(self, query):
-        """Retrieves data from the database"""
-        return self.retriever.get_relevant_documents(query)
\ No newline at end of file
+        """Retrieves data from the database, vector matches carry their cosine similarity in metadata["similarity"]"""
+        if not self.hybrid:
+            return self._vector_search(query, self.k)
+        return self._fuse(self._vector_search(query, self.candidate_k), self._lexical_search(query))
+
+    async def arun(self, query):
+        """Asynchronously retrieves data from the database"""
+        if not self.hybrid:
+            return await self._avector_search(query, self.k)
+        return self._fuse(await self._avector_search(query, self.candidate_k), self._lexical_search(query))
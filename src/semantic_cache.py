@@ -0,0 +1,177 @@
+"""Implements the SemanticCache class for reusing responses to previously answered questions"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from cache_store import FileVersion, manifest_corpus_version
+
+
+def file_content_hash(path):
+    """Returns the sha256 hash of a file's content"""
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+class SemanticCache:
+    """
+    Caches responses keyed on the embedding of the standalone question.
+
+    A lookup returns the stored response of the most similar cached question, if its cosine similarity is at least
+    the similarity threshold. Entries are evicted least recently used first once the cache is full, and expire after
+    the ttl. The cache is cleared whenever the content hash of the source data, which the all data answers are
+    generated from, or the corpus version in the ingestion manifest, which the retrieved chunks come from, changes.
+    """
+
+    _EMBEDDING_MEMO_SIZE = 64
+
+    def __init__(
+        self,
+        embedding_model,
+        source_data_path,
+        manifest_path=None,
+        similarity_threshold=0.95,
+        max_size=256,
+        ttl=3600,
+        persist_path=None,
+    ):
+        """
+        Args:
+            embedding_model: The model used to embed the questions
+            source_data_path (str): The path to the source data the cached responses were generated from
+            manifest_path (str): The ingestion manifest holding the corpus version, None to only watch the source data
+            similarity_threshold (float): Minimum cosine similarity for a cached question to match
+            max_size (int): Maximum number of cached responses
+            ttl (float): Seconds after which a cached response expires, None to never expire
+            persist_path (str): Path of an SQLite file to persist the cache to, None to keep it in memory only
+        """
+        self.embedding_model = embedding_model
+        self.source_data_path = source_data_path
+        self.similarity_threshold = similarity_threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persist_path = persist_path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # question -> (normalized embedding, response, created at)
+        self._entries = OrderedDict()
+        # embeddings of recently looked up questions, so a miss is not embedded again when its response is stored
+        self._embedding_memo = OrderedDict()
+        self._source = FileVersion(source_data_path, file_content_hash)
+        self._manifest = FileVersion(manifest_path, manifest_corpus_version)
+        self._corpus_hash = None
+        self._db = None
+        if persist_path:
+            self._db = sqlite3.connect(persist_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS semantic_cache "
+                "(question TEXT PRIMARY KEY, embedding BLOB, response TEXT, created_at REAL, corpus_hash TEXT)"
+            )
+        with self._lock:
+            self._check_corpus()
+            self._load()
+
+    def _check_corpus(self):
+        """Clears the cache if the source data changed or the corpus was re-ingested"""
+        corpus_hash = f"{self._source.check()}:{self._manifest.check()}"
+        if corpus_hash != self._corpus_hash:
+            self._corpus_hash = corpus_hash
+            self._entries.clear()
+            if self._db is not None:
+                with self._db:
+                    self._db.execute("DELETE FROM semantic_cache WHERE corpus_hash != ?", (corpus_hash,))
+
+    def _load(self):
+        """Loads the persisted entries of the current corpus, oldest first"""
+        if self._db is None:
+            return
+        rows = self._db.execute(
+            "SELECT question, embedding, response, created_at FROM semantic_cache WHERE corpus_hash = ? ORDER BY created_at",
+            (self._corpus_hash,),
+        ).fetchall()
+        for question, embedding, response, created_at in rows[-self.max_size:]:
+            self._entries[question] = (np.frombuffer(embedding, dtype=np.float32), response, created_at)
+
+    def _expired(self, created_at, now):
+        return self.ttl is not None and now - created_at > self.ttl
+
+    def _delete(self, questions):
+        for question in questions:
+            self._entries.pop(question, None)
+        if self._db is not None and questions:
+            with self._db:
+                self._db.executemany("DELETE FROM semantic_cache WHERE question = ?", [(q,) for q in questions])
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remember_embedding(self, question, vector):
+        self._embedding_memo[question] = vector
+        self._embedding_memo.move_to_end(question)
+        while len(self._embedding_memo) > self._EMBEDDING_MEMO_SIZE:
+            self._embedding_memo.popitem(last=False)
+
+    def _match(self, question, vector):
+        """Returns the response of the most similar unexpired cached question, if similar enough"""
+        with self._lock:
+            self._check_corpus()
+            self._remember_embedding(question, vector)
+            now = time.time()
+            self._delete([q for q, (_, _, created_at) in self._entries.items() if self._expired(created_at, now)])
+            if not self._entries:
+                self.misses += 1
+                return None
+            questions = list(self._entries)
+            similarities = np.stack([self._entries[q][0] for q in questions]) @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.similarity_threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(questions[best])
+            return self._entries[questions[best]][1]
+
+    def _store(self, question, vector, response):
+        """Stores a response, evicting the least recently used entries beyond the size bound"""
+        with self._lock:
+            self._check_corpus()
+            created_at = time.time()
+            self._entries[question] = (vector, response, created_at)
+            self._entries.move_to_end(question)
+            if self._db is not None:
+                with self._db:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO semantic_cache VALUES (?, ?, ?, ?, ?)",
+                        (question, vector.tobytes(), response, created_at, self._corpus_hash),
+                    )
+            self._delete(list(self._entries)[:max(len(self._entries) - self.max_size, 0)])
+
+    def lookup(self, question):
+        """Returns the cached response for a question similar to the given one, or None"""
+        return self._match(question, self._normalize(self.embedding_model.embed_query(question)))
+
+    async def alookup(self, question):
+        """Asynchronously returns the cached response for a question similar to the given one, or None"""
+        return self._match(question, self._normalize(await self.embedding_model.aembed_query(question)))
+
+    def put(self, question, response):
+        """Caches the response to a question"""
+        vector = self._embedding_memo.get(question)
+        if vector is None:
+            vector = self._normalize(self.embedding_model.embed_query(question))
+        self._store(question, vector, response)
+
+    async def aput(self, question, response):
+        """Asynchronously caches the response to a question"""
+        vector = self._embedding_memo.get(question)
+        if vector is None:
+            vector = self._normalize(await self.embedding_model.aembed_query(question))
+        self._store(question, vector, response)
@@ -0,0 +1,67 @@
+"""Implements a compact in-process vector index stored as a memory-mapped NumPy matrix"""
+
+import json
+import os
+
+import numpy as np
+from langchain_core.documents import Document
+
+EMBEDDINGS_FILE = "embeddings.npy"
+DOCUMENTS_FILE = "documents.json"
+
+
+def normalize_rows(matrix):
+    """Returns the matrix as float32 with each row scaled to unit length"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def write_vector_index(index_path, texts, metadatas, embeddings):
+    """
+    Writes the normalized embeddings and a parallel array of texts and metadata to the index directory
+
+    Args:
+        index_path (str): The directory to write the index to
+        texts (list): The text of each chunk
+        metadatas (list): The metadata of each chunk
+        embeddings (list): The embedding of each chunk
+    """
+    os.makedirs(index_path, exist_ok=True)
+    # write to temporary files first, so readers never map a half written index
+    embeddings_path = os.path.join(index_path, EMBEDDINGS_FILE)
+    with open(embeddings_path + ".tmp", "wb") as file:
+        np.save(file, normalize_rows(embeddings) if len(embeddings) else np.zeros((0, 0), dtype=np.float32))
+    documents_path = os.path.join(index_path, DOCUMENTS_FILE)
+    with open(documents_path + ".tmp", "w") as file:
+        json.dump([{"page_content": text, "metadata": metadata or {}} for text, metadata in zip(texts, metadatas)], file)
+    os.replace(embeddings_path + ".tmp", embeddings_path)
+    os.replace(documents_path + ".tmp", documents_path)
+
+
+class VectorIndex:
+    """
+    Searches normalized chunk embeddings by cosine similarity.
+
+    The embedding matrix is memory-mapped read only, so worker processes on the same host share one page-cached copy.
+    """
+
+    def __init__(self, index_path):
+        self.embeddings = np.load(os.path.join(index_path, EMBEDDINGS_FILE), mmap_mode="r")
+        with open(os.path.join(index_path, DOCUMENTS_FILE), "r") as file:
+            self.documents = [Document(**document) for document in json.load(file)]
+
+    def __len__(self):
+        return len(self.documents)
+
+    def search(self, query_embedding, k=4):
+        """Returns the k most similar documents and their cosine similarities, most similar first"""
+        if not len(self.documents):
+            return []
+        query = normalize_rows(query_embedding)
+        similarities = self.embeddings @ query
+        k = min(k, len(similarities))
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+        return [(self.documents[i], float(similarities[i])) for i in top]
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules under src import each other as top level modules, as when running the scripts in src
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
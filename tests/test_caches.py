@@ -0,0 +1,128 @@
+import json
+import os
+import time
+
+import pytest
+
+from cache_store import FileVersion, PersistentLRU
+from embedding_cache import CachedEmbeddings
+from fake_models import FakeEmbeddings
+from grade_cache import GradeCache
+from semantic_cache import SemanticCache
+
+
+def write_manifest(path, version):
+    with open(path, "w") as file:
+        json.dump({"corpus_version": version}, file)
+    # the caches reread a file when its mtime or size changes, make sure the mtime does
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+
+
+@pytest.fixture
+def manifest_path(tmp_path):
+    path = str(tmp_path / "manifest.json")
+    write_manifest(path, "v1")
+    return path
+
+
+def test_persistent_lru_evicts_from_memory_but_not_from_disk(tmp_path):
+    store = PersistentLRU("test_cache", str(tmp_path / "cache.sqlite3"), max_size=2)
+    store.put_many([("a", 1), ("b", 2), ("c", 3)])
+    assert list(store._memory) == ["b", "c"]
+    assert store.get_many(["a", "b", "missing"]) == [1, 2, None]
+
+
+def test_persistent_lru_bounds_the_table(tmp_path):
+    store = PersistentLRU("test_cache", str(tmp_path / "cache.sqlite3"), max_size=1, max_rows=3, prune_every=1)
+    for i in range(5):
+        store.put_many([(str(i), i)])
+    assert store._db.execute("SELECT COUNT(*) FROM test_cache").fetchone() == (3,)
+    assert store.get_many(["0", "1", "4"]) == [None, None, 4]
+
+
+def test_persistent_lru_expires_values(tmp_path):
+    store = PersistentLRU("test_cache", str(tmp_path / "cache.sqlite3"), ttl=0.05)
+    store.put_many([("a", 1)])
+    assert store.get_many(["a"]) == [1]
+    time.sleep(0.1)
+    assert store.get_many(["a"]) == [None]
+
+
+def test_file_version_keeps_the_last_version_of_an_unreadable_file(manifest_path):
+    version = FileVersion(manifest_path, lambda path: json.load(open(path))["corpus_version"])
+    assert version.check() == "v1"
+    with open(manifest_path, "w") as file:
+        file.write('{"corpus_vers')
+    assert version.check() == "v1"
+    write_manifest(manifest_path, "v2")
+    assert version.check() == "v2"
+
+
+def test_grade_cache_persists_verdicts_across_instances(tmp_path, manifest_path):
+    persist_path = str(tmp_path / "grade_cache.sqlite3")
+    GradeCache(manifest_path, persist_path).put("grader-v1", "Where does Sajal work?", "He works at X.", "yes")
+    cache = GradeCache(manifest_path, persist_path)
+    # questions are normalized, contexts and grader versions are not
+    assert cache.get_many("grader-v1", "  where does sajal   WORK? ", ["He works at X.", "he works at x."]) == ["yes", None]
+    assert cache.get_many("grader-v2", "Where does Sajal work?", ["He works at X."]) == [None]
+    assert cache.stats() == {"hits": 1, "misses": 2}
+
+
+def test_grade_cache_drops_verdicts_on_reingestion(tmp_path, manifest_path):
+    persist_path = str(tmp_path / "grade_cache.sqlite3")
+    cache = GradeCache(manifest_path, persist_path)
+    other_worker = GradeCache(manifest_path, persist_path)
+    cache.put("grader-v1", "question", "context", "yes")
+    write_manifest(manifest_path, "v2")
+    assert cache.get_many("grader-v1", "question", ["context"]) == [None]
+    assert other_worker.get_many("grader-v1", "question", ["context"]) == [None]
+    assert GradeCache(manifest_path, persist_path).get_many("grader-v1", "question", ["context"]) == [None]
+
+
+def test_cached_embeddings_only_embed_misses(tmp_path):
+    model = FakeEmbeddings()
+    cache = CachedEmbeddings(model, persist_path=str(tmp_path / "embedding_cache.sqlite3"))
+    first = cache.embed_documents(["where does sajal work", "what are his skills"])
+    assert cache.stats() == {"hits": 0, "misses": 2}
+    assert cache.embed_query("Where does  Sajal work") == first[0]
+    restarted = CachedEmbeddings(model, persist_path=str(tmp_path / "embedding_cache.sqlite3"))
+    assert restarted.embed_documents(["what are his skills"]) == [first[1]]
+    assert restarted.stats() == {"hits": 1, "misses": 0}
+
+
+@pytest.fixture
+def source_path(tmp_path):
+    path = str(tmp_path / "source.md")
+    with open(path, "w") as file:
+        file.write("# Sajal\nSajal works at X.")
+    return path
+
+
+def test_semantic_cache_matches_similar_questions(source_path, manifest_path):
+    cache = SemanticCache(FakeEmbeddings(), source_path, manifest_path, similarity_threshold=0.9)
+    cache.put("where does sajal work", "At X.")
+    assert cache.lookup("where does sajal work") == "At X."
+    assert cache.lookup("what are his hobbies") is None
+
+
+def test_semantic_cache_clears_when_the_source_changes(source_path, manifest_path):
+    cache = SemanticCache(FakeEmbeddings(), source_path, manifest_path)
+    cache.put("where does sajal work", "At X.")
+    with open(source_path, "a") as file:
+        file.write("\nHe moved to Y.")
+    assert cache.lookup("where does sajal work") is None
+
+
+def test_semantic_cache_clears_on_reingestion(tmp_path, source_path, manifest_path):
+    persist_path = str(tmp_path / "semantic_cache.sqlite3")
+    cache = SemanticCache(FakeEmbeddings(), source_path, manifest_path, persist_path=persist_path)
+    cache.put("where does sajal work", "At X.")
+    assert SemanticCache(FakeEmbeddings(), source_path, manifest_path, persist_path=persist_path).lookup(
+        "where does sajal work"
+    ) == "At X."
+    write_manifest(manifest_path, "v2")
+    assert cache.lookup("where does sajal work") is None
+    assert SemanticCache(FakeEmbeddings(), source_path, manifest_path, persist_path=persist_path).lookup(
+        "where does sajal work"
+    ) is None
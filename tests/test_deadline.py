@@ -0,0 +1,82 @@
+import asyncio
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from deadline import (
+    DEADLINE_KEY,
+    DeadlineExceeded,
+    await_with_timeout,
+    call_timeout,
+    call_with_timeout,
+    carry_deadline,
+    deadline_after,
+    time_left,
+)
+
+
+def test_call_timeout_is_the_smaller_of_the_timeout_and_the_time_left():
+    assert call_timeout(None) is None
+    assert call_timeout(None, 2.0) == 2.0
+    deadline = deadline_after(10)
+    assert 9 < call_timeout(deadline) <= 10
+    assert call_timeout(deadline, 2.0) == 2.0
+    assert call_timeout(deadline_after(1), 5.0) <= 1
+    assert time_left(deadline_after(-1)) < 0
+
+
+def test_call_with_timeout_returns_in_time():
+    with ThreadPoolExecutor() as executor:
+        assert call_with_timeout(executor, 1.0, lambda x: x * 2, 21) == 42
+        # without a timeout the function runs in the calling thread
+        assert call_with_timeout(None, None, lambda: "direct") == "direct"
+
+
+def test_call_with_timeout_gives_up_on_slow_calls():
+    with ThreadPoolExecutor() as executor:
+        start = time.monotonic()
+        with pytest.raises(DeadlineExceeded):
+            call_with_timeout(executor, 0.05, time.sleep, 0.5)
+        assert time.monotonic() - start < 0.4
+        with pytest.raises(DeadlineExceeded, match="no time left"):
+            call_with_timeout(executor, 0, lambda: None)
+
+
+def test_call_with_timeout_runs_in_the_callers_context():
+    request = contextvars.ContextVar("request")
+    request.set("turn-1")
+    with ThreadPoolExecutor() as executor:
+        assert call_with_timeout(executor, 1.0, request.get) == "turn-1"
+
+
+def test_await_with_timeout():
+    async def slow():
+        await asyncio.sleep(0.5)
+
+    async def run():
+        assert await await_with_timeout(asyncio.sleep(0, result="done"), None) == "done"
+        assert await await_with_timeout(asyncio.sleep(0, result="done"), 1.0) == "done"
+        with pytest.raises(DeadlineExceeded):
+            await await_with_timeout(slow(), 0.05)
+        # a deadline already passed fails a pending awaitable
+        with pytest.raises(DeadlineExceeded):
+            await await_with_timeout(slow(), -1)
+
+    asyncio.run(run())
+
+
+def test_carry_deadline_copies_the_deadline_into_the_result():
+    @carry_deadline
+    def node(state):
+        return {"keys": {"response": "hi"}}
+
+    @carry_deadline
+    async def anode(state):
+        return {"keys": {"response": "hi"}}
+
+    state = {"keys": {"message": "hello", DEADLINE_KEY: 123.0}}
+    assert node(state) == {"keys": {"response": "hi", DEADLINE_KEY: 123.0}}
+    assert asyncio.run(anode(state)) == {"keys": {"response": "hi", DEADLINE_KEY: 123.0}}
+    assert node({"keys": {"message": "hello"}}) == {"keys": {"response": "hi"}}
@@ -0,0 +1,86 @@
+import asyncio
+import re
+import time
+
+import pytest
+
+from chains.document_grader import DocumentGrader
+from fake_models import FakeChatModel
+
+QUESTION = "who is sajal's current employer"
+RELEVANT = "His current employer is X, where he leads the ML team."
+IRRELEVANT = "Sajal enjoys hiking and photography."
+
+
+class ScriptedGrader(FakeChatModel):
+    """Grades like FakeChatModel, after a delay set per document, failing the documents mentioning 'boom'"""
+
+    delays: dict = {}
+    calls: list = []
+
+    def _script(self, messages):
+        prompt = "\n".join(str(message.content) for message in messages)
+        document = re.search(r"Retrieved document:(.*)User Question:", prompt, re.S).group(1).strip()
+        self.calls.append(document)
+        if "boom" in document:
+            raise RuntimeError("rate limited")
+        return self.delays.get(document, 0.0)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self._script(messages))
+        return super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self._script(messages))
+        return await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+
+def grader(delays=None):
+    return DocumentGrader(llm=ScriptedGrader(delays=delays or {}, calls=[]))
+
+
+def run_many(grader, mode, *args, **kwargs):
+    if mode == "sync":
+        return grader.run_many(*args, **kwargs)
+    return asyncio.run(grader.arun_many(*args, **kwargs))
+
+
+def calls(grader):
+    return grader._grader_chain.steps[1].bound.calls
+
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+@pytest.mark.parametrize("max_relevant", [None, 5])
+def test_scores_come_back_in_context_order(mode, max_relevant):
+    # the first context finishes last
+    document_grader = grader({RELEVANT: 0.1})
+    scores = run_many(document_grader, mode, QUESTION, [RELEVANT, IRRELEVANT, RELEVANT + " "], max_relevant=max_relevant)
+    assert scores == ["yes", "no", "yes"]
+
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+def test_stops_once_enough_relevant_contexts_are_found(mode):
+    # the call after the first may start before the rest are cancelled, it is slow so they are cancelled first
+    document_grader = grader({IRRELEVANT: 0.2})
+    contexts = [RELEVANT, IRRELEVANT, RELEVANT + " ", IRRELEVANT + " "]
+    scores = run_many(document_grader, mode, QUESTION, contexts, max_concurrency=1, max_relevant=1)
+    assert scores == ["yes", "no", "no", "no"]
+    assert calls(document_grader) in ([RELEVANT], [RELEVANT, IRRELEVANT])
+
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+@pytest.mark.parametrize("max_relevant", [None, 5])
+def test_failed_calls_score_no_and_are_counted(mode, max_relevant, caplog):
+    document_grader = grader()
+    scores, failures = run_many(
+        document_grader, mode, QUESTION, [RELEVANT + " boom", RELEVANT], max_relevant=max_relevant, with_failures=True
+    )
+    assert scores == ["no", "yes"]
+    assert failures == 1
+    assert "document grader call failed" in caplog.text
+
+
+def test_zero_max_relevant_grades_nothing():
+    document_grader = grader()
+    assert document_grader.run_many(QUESTION, [RELEVANT], max_relevant=0) == ["no"]
+    assert calls(document_grader) == []
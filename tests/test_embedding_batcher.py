@@ -0,0 +1,94 @@
+import asyncio
+import threading
+
+import pytest
+
+from embedding_batcher import BatchingEmbeddings
+from fake_models import FakeEmbeddings
+
+
+class RecordingEmbeddings(FakeEmbeddings):
+    """Records the texts of every embed_documents call"""
+
+    def __init__(self, fail=False, **kwargs):
+        super().__init__(**kwargs)
+        self.fail = fail
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        with self._lock:
+            self.calls.append(list(texts))
+        if self.fail:
+            raise RuntimeError("embeddings API down")
+        return super().embed_documents(texts)
+
+
+def embed_concurrently(batcher, texts):
+    results = [None] * len(texts)
+    barrier = threading.Barrier(len(texts))
+
+    def embed(i):
+        barrier.wait()
+        results[i] = batcher.embed_query(texts[i])
+
+    threads = [threading.Thread(target=embed, args=(i,)) for i in range(len(texts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_queries_share_one_call():
+    model = RecordingEmbeddings()
+    batcher = BatchingEmbeddings(model, max_wait=0.2)
+    texts = ["where does sajal work", "what are his skills", "how can I contact him"]
+    results = embed_concurrently(batcher, texts)
+    assert len(model.calls) == 1
+    assert sorted(model.calls[0]) == sorted(texts)
+    assert results == [model._embed(text) for text in texts]
+    assert batcher.stats() == {"batches": 1, "queries": 3, "mean_batch_size": 3.0}
+
+
+def test_identical_queries_are_embedded_once():
+    model = RecordingEmbeddings()
+    batcher = BatchingEmbeddings(model, max_wait=0.2)
+    results = embed_concurrently(batcher, ["hello there"] * 4)
+    assert model.calls == [["hello there"]]
+    assert results == [model._embed("hello there")] * 4
+
+
+def test_batches_are_capped_at_max_batch_size():
+    model = RecordingEmbeddings()
+    batcher = BatchingEmbeddings(model, max_wait=0.2, max_batch_size=2)
+    embed_concurrently(batcher, ["a b", "c d", "e f", "g h"])
+    assert all(len(call) <= 2 for call in model.calls)
+    assert sorted(text for call in model.calls for text in call) == ["a b", "c d", "e f", "g h"]
+
+
+def test_a_failed_call_fails_every_caller_of_the_batch():
+    batcher = BatchingEmbeddings(RecordingEmbeddings(fail=True), max_wait=0.05)
+    with pytest.raises(RuntimeError, match="embeddings API down"):
+        batcher.embed_query("hi")
+
+
+def test_async_callers_share_batches_with_sync_ones():
+    model = RecordingEmbeddings()
+    batcher = BatchingEmbeddings(model, max_wait=0.2)
+
+    async def embed():
+        return await asyncio.gather(batcher.aembed_query("first question"), batcher.aembed_query("second question"))
+
+    results = asyncio.run(embed())
+    assert len(model.calls) == 1
+    assert results == [model._embed("first question"), model._embed("second question")]
+
+
+def test_documents_go_straight_to_the_model():
+    model = RecordingEmbeddings()
+    batcher = BatchingEmbeddings(model)
+    assert batcher.embed_documents(["one", "two"]) == model.embed_documents(["one", "two"])
+    assert batcher.stats()["batches"] == 0
+    # the collector thread is only started by the first query
+    assert batcher._executor is None
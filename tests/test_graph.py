@@ -0,0 +1,104 @@
+import asyncio
+import os
+import shutil
+
+import pytest
+from langchain_core.documents import Document
+
+from deadline import deadline_after
+from fake_models import FakeChatModel, FakeEmbeddings
+from graph import AssistantGraph
+from ingest_data import ingest
+from metrics import GRADING_DECISIONS
+
+SOURCE_DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "source.md")
+
+
+@pytest.fixture(scope="module")
+def data_dir(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp("data")
+    source_path = shutil.copy(SOURCE_DATA_PATH, data_dir / "source.md")
+    ingest(
+        source_path=str(source_path),
+        vector_db_path=str(data_dir / "chroma_db"),
+        manifest_path=str(data_dir / "manifest.json"),
+        vector_index_path=str(data_dir / "vector_index"),
+        bm25_index_path=str(data_dir / "bm25_index.json"),
+        sections_path=str(data_dir / "sections.json"),
+        embeddings_model=FakeEmbeddings(),
+    )
+    return data_dir
+
+
+def build_graph(data_dir, llm=None, **options):
+    llm = llm or FakeChatModel()
+    return AssistantGraph(
+        llm=llm,
+        vector_db_path=str(data_dir / "chroma_db"),
+        source_data_path=str(data_dir / "source.md"),
+        embedding_model=FakeEmbeddings(),
+        grader_llm=llm,
+        retriever_options={"embedding_cache_path": ":memory:"},
+        use_grade_cache=False,
+        **options,
+    )
+
+
+def stream(graph, message):
+    async def collect():
+        return [token async for token in graph.astream({"keys": {"message": message, "history": []}})]
+
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize("message", ["hi", "where does sajal work?", "what is his favourite colour?"])
+def test_astream_yields_the_answer_token_by_token(data_dir, message):
+    graph = build_graph(data_dir)
+    tokens = stream(graph, message)
+    assert len(tokens) == FakeChatModel().answer_tokens
+    response = graph.run({"keys": {"message": message, "history": []}})["keys"]["response"]
+    assert "".join(tokens).strip() == response
+
+
+def test_astream_only_tracks_the_answering_nodes(data_dir, caplog):
+    # tracking every run made the log stream fail to copy the grader's pydantic outputs, warning once per chunk
+    stream(build_graph(data_dir), "where does sajal work?")
+    assert not [record for record in caplog.records if "LogStreamCallbackHandler" in record.getMessage()]
+
+
+def documents(*similarities):
+    return [Document(page_content=f"document {i}", metadata={"similarity": similarity}) for i, similarity in enumerate(similarities)]
+
+
+def test_the_grading_cascade_decides_clear_cut_similarities(data_dir):
+    graph = build_graph(data_dir, grading_cascade=True, grading_accept_threshold=0.9, grading_reject_threshold=0.75)
+    before = {decision: GRADING_DECISIONS.value(decision=decision) for decision in graph.grading_counters}
+    grades = graph._grade_by_similarity(documents(0.95, 0.9, 0.8, 0.75, 0.7, None))
+    assert grades == ["yes", "yes", None, None, "no", None]
+    assert graph.grading_counters == {"accepted": 2, "rejected": 1, "llm_graded": 3}
+    assert {decision: GRADING_DECISIONS.value(decision=decision) - count for decision, count in before.items()} == (
+        graph.grading_counters
+    )
+
+
+def test_without_the_grading_cascade_every_document_goes_to_the_grader(data_dir):
+    graph = build_graph(data_dir)
+    assert graph._grade_by_similarity(documents(0.99, 0.1)) == [None, None]
+    assert graph.grading_counters == {"accepted": 0, "rejected": 0, "llm_graded": 2}
+
+
+@pytest.mark.parametrize(
+    "seconds, expected, degraded, grades",
+    [
+        (None, [0, 2, 3], None, [None, "no", None, None]),
+        (60, [0, 2, 3], None, [None, "no", None, None]),
+        (3, [0, 2], "grading_capped", [None, "no", None, "no"]),
+        (1, [], "grading_skipped", ["yes", "no", "yes", "yes"]),
+    ],
+)
+def test_grading_shrinks_as_the_deadline_nears(data_dir, seconds, expected, degraded, grades):
+    graph = build_graph(data_dir, grading_skip_below=2.0, grading_cap_below=5.0, degraded_max_grader_calls=2)
+    similarity_grades = [None, "no", None, None]
+    deadline = None if seconds is None else deadline_after(seconds)
+    assert graph._documents_to_grade(similarity_grades, deadline) == (expected, degraded)
+    assert similarity_grades == grades
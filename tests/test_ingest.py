@@ -0,0 +1,82 @@
+import pytest
+from langchain_community.vectorstores import Chroma
+
+import ingest_data
+from fake_models import FakeEmbeddings
+from ingest_data import ingest
+
+SOURCE = """# Sajal Sharma
+Sajal is an AI engineer.
+
+## Experience
+He works at X.
+
+## Education
+He studied at Y.
+"""
+
+
+class RecordingEmbeddings(FakeEmbeddings):
+    """Records the texts it embeds"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.embedded = []
+
+    def embed_documents(self, texts):
+        self.embedded += texts
+        return super().embed_documents(texts)
+
+
+@pytest.fixture
+def paths(tmp_path):
+    source_path = tmp_path / "source.md"
+    source_path.write_text(SOURCE)
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    return {
+        "source_path": str(source_path),
+        "vector_db_path": str(data_dir / "chroma_db"),
+        "manifest_path": str(data_dir / "manifest.json"),
+        "vector_index_path": str(data_dir / "vector_index"),
+        "bm25_index_path": str(data_dir / "bm25_index.json"),
+        "sections_path": str(data_dir / "sections.json"),
+    }
+
+
+def stored_contents(paths):
+    collection = Chroma(persist_directory=paths["vector_db_path"], embedding_function=FakeEmbeddings())._collection
+    return sorted(collection.get(include=["documents"])["documents"])
+
+
+def test_reingesting_an_unchanged_source_embeds_nothing(paths):
+    manifest = ingest(**paths, embeddings_model=RecordingEmbeddings())
+    stored = stored_contents(paths)
+    embeddings = RecordingEmbeddings()
+    reingested = ingest(**paths, embeddings_model=embeddings)
+    assert embeddings.embedded == []
+    assert reingested["corpus_version"] == manifest["corpus_version"]
+    assert reingested["chunk_ids"] == manifest["chunk_ids"]
+    assert stored_contents(paths) == stored
+
+
+def test_removed_sections_are_deleted_from_the_store(paths):
+    manifest = ingest(**paths, embeddings_model=RecordingEmbeddings())
+    with open(paths["source_path"], "w") as file:
+        file.write(SOURCE.split("## Education")[0])
+    embeddings = RecordingEmbeddings()
+    reingested = ingest(**paths, embeddings_model=embeddings)
+    assert embeddings.embedded == []
+    assert set(reingested["chunk_ids"]) < set(manifest["chunk_ids"])
+    assert reingested["corpus_version"] != manifest["corpus_version"]
+    assert len(stored_contents(paths)) == len(reingested["chunk_ids"])
+    assert not any("He studied at Y." in content for content in stored_contents(paths))
+
+
+def test_a_tokenizer_change_re_embeds_nothing(paths, monkeypatch):
+    manifest = ingest(**paths, embeddings_model=RecordingEmbeddings())
+    # e.g. tiktoken could not load the model's encoding offline, and the token counts are estimated
+    monkeypatch.setattr(ingest_data, "count_tokens", lambda text, model=None: len(text))
+    embeddings = RecordingEmbeddings()
+    assert ingest(**paths, embeddings_model=embeddings)["corpus_version"] == manifest["corpus_version"]
+    assert embeddings.embedded == []
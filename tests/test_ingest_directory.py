@@ -0,0 +1,108 @@
+import json
+import os
+
+import pytest
+from langchain_community.vectorstores import Chroma
+
+from fake_models import FakeEmbeddings
+from ingest_data import ingest, ingest_directory, load_checkpoint
+
+
+class FlakyEmbeddings(FakeEmbeddings):
+    """Records the texts it embeds, and fails every call after the first fail_after ones"""
+
+    def __init__(self, fail_after=None, **kwargs):
+        super().__init__(**kwargs)
+        self.fail_after = fail_after
+        self.embedded = []
+
+    def embed_documents(self, texts):
+        if self.fail_after is not None and len(self.embedded) >= self.fail_after:
+            raise RuntimeError("embeddings API down")
+        self.embedded.append(list(texts))
+        return super().embed_documents(texts)
+
+
+def write_docs(source_dir, count, sections=3):
+    os.makedirs(source_dir, exist_ok=True)
+    for i in range(count):
+        with open(os.path.join(source_dir, f"doc{i}.md"), "w") as file:
+            file.write("\n\n".join(f"# Doc {i} section {j}\nContent {j} of document {i}." for j in range(sections)))
+
+
+@pytest.fixture
+def paths(tmp_path):
+    return {
+        "source_dir": str(tmp_path / "docs"),
+        "vector_db_path": str(tmp_path / "data" / "chroma_db"),
+        "manifest_path": str(tmp_path / "data" / "manifest.json"),
+        "checkpoint_path": str(tmp_path / "data" / "ingest_checkpoint.jsonl"),
+    }
+
+
+def stored_sources(paths):
+    collection = Chroma(persist_directory=paths["vector_db_path"], embedding_function=FakeEmbeddings())._collection
+    return sorted(metadata["source"] for metadata in collection.get(include=["metadatas"])["metadatas"])
+
+
+def test_resumes_from_the_first_unfinished_file(paths):
+    os.makedirs(os.path.dirname(paths["vector_db_path"]))
+    write_docs(paths["source_dir"], 4)
+    # one file per batch, the run dies embedding the third one
+    flaky = FlakyEmbeddings(fail_after=2)
+    with pytest.raises(RuntimeError):
+        ingest_directory(**paths, batch_size=3, max_concurrency=1, max_retries=0, embeddings_model=flaky)
+    finished = {path for path, sha256 in load_checkpoint(paths["checkpoint_path"]).items() if sha256}
+    assert finished == {"doc0.md", "doc1.md"}
+    assert not os.path.exists(paths["manifest_path"])
+
+    embeddings = FlakyEmbeddings()
+    stats = ingest_directory(**paths, batch_size=3, max_concurrency=1, embeddings_model=embeddings)
+    assert stats["skipped_files"] == 2
+    assert stats["files"] == 2
+    # the chunks written before the interruption are not embedded again
+    assert not any("document 0" in text or "document 1" in text for call in embeddings.embedded for text in call)
+    assert stored_sources(paths) == sorted(f"doc{i}.md" for i in range(4) for _ in range(3))
+    with open(paths["manifest_path"]) as file:
+        manifest = json.load(file)
+    assert manifest["mode"] == "directory"
+    assert len(manifest["chunk_ids"]) == 12
+
+
+def test_changed_and_deleted_files_replace_their_chunks(paths):
+    os.makedirs(os.path.dirname(paths["vector_db_path"]))
+    write_docs(paths["source_dir"], 3)
+    ingest_directory(**paths, embeddings_model=FlakyEmbeddings())
+    write_docs(paths["source_dir"], 1, sections=1)
+    os.remove(os.path.join(paths["source_dir"], "doc2.md"))
+
+    embeddings = FlakyEmbeddings()
+    stats = ingest_directory(**paths, embeddings_model=embeddings)
+    assert stats["skipped_files"] == 1
+    assert stats["removed_files"] == 1
+    assert embeddings.embedded == [["# Doc 0 section 0\nContent 0 of document 0."]]
+    assert stored_sources(paths) == ["doc0.md", "doc1.md", "doc1.md", "doc1.md"]
+    assert set(load_checkpoint(paths["checkpoint_path"])) == {"doc0.md", "doc1.md"}
+
+
+def test_refuses_to_mix_modes_without_rebuild(paths, tmp_path):
+    os.makedirs(os.path.dirname(paths["vector_db_path"]))
+    write_docs(paths["source_dir"], 2)
+    ingest_directory(**paths, embeddings_model=FlakyEmbeddings())
+    source_path = os.path.join(paths["source_dir"], "doc0.md")
+    file_paths = {
+        "source_path": source_path,
+        "vector_db_path": paths["vector_db_path"],
+        "manifest_path": paths["manifest_path"],
+        "vector_index_path": str(tmp_path / "data" / "vector_index"),
+        "bm25_index_path": str(tmp_path / "data" / "bm25_index.json"),
+        "sections_path": str(tmp_path / "data" / "sections.json"),
+    }
+    with pytest.raises(ValueError, match="directory ingestion"):
+        ingest(**file_paths, embeddings_model=FlakyEmbeddings())
+    assert len(stored_sources(paths)) == 6
+
+    manifest = ingest(**file_paths, rebuild=True, embeddings_model=FlakyEmbeddings())
+    assert manifest["mode"] == "file"
+    with pytest.raises(ValueError, match="file ingestion"):
+        ingest_directory(**paths, embeddings_model=FlakyEmbeddings())
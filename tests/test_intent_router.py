@@ -0,0 +1,20 @@
+from fake_models import FakeEmbeddings
+from intent_router import IntentRouter
+from metrics import INTENT_DECISIONS
+
+
+class StaticIntentDetector:
+    """Detects the same intent for every message"""
+
+    def run(self, message, history):
+        return "sajal_question"
+
+
+def test_each_tier_decision_is_counted():
+    router = IntentRouter(StaticIntentDetector(), FakeEmbeddings())
+    before = {tier: INTENT_DECISIONS.value(tier=tier) for tier in router.counters}
+    history = [("hi", "Hello! How can I help?")]
+    assert router.run("Hi!", history) == "smalltalk"
+    assert router.run("tell me more", history) == "sajal_question"
+    assert router.stats() == {"phrase": 1, "centroid": 0, "llm": 1, "llm_calls_avoided": 1}
+    assert {tier: INTENT_DECISIONS.value(tier=tier) - count for tier, count in before.items()} == router.counters
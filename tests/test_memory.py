@@ -0,0 +1,84 @@
+import asyncio
+
+from langchain_core.messages import SystemMessage
+
+from context_packing import count_tokens
+from memory import ConversationMemory
+
+
+class CountingSummarizer:
+    """Records the lines it is asked to fold, appending them to the summary, and fails while failing is set"""
+
+    def __init__(self):
+        self.calls = []
+        self.failing = False
+
+    def run(self, summary, new_lines):
+        self.calls.append(new_lines)
+        if self.failing:
+            raise RuntimeError("summarizer down")
+        return f"{summary} {new_lines}".strip()
+
+    async def arun(self, summary, new_lines):
+        return self.run(summary, new_lines)
+
+
+def conversation(count):
+    return [(f"question {i}", f"answer {i}") for i in range(count)]
+
+
+def contents(messages):
+    return [message.content for message in messages]
+
+
+def test_each_turn_is_summarized_once():
+    summarizer = CountingSummarizer()
+    memory = ConversationMemory(summarizer, max_turns=2, token_budget=None)
+    for count in range(3, 7):
+        memory.view(conversation(count))
+    # every view only folds the turn that left the verbatim window
+    assert summarizer.calls == [f"User: question {i}\nSaj: answer {i}" for i in range(4)]
+    messages = memory.view(conversation(6))
+    assert len(summarizer.calls) == 4
+    assert isinstance(messages[0], SystemMessage)
+    assert "question 3" in messages[0].content
+    assert contents(messages[1:]) == ["question 4", "answer 4", "question 5", "answer 5"]
+
+
+def test_aview_reuses_the_prefetched_summary():
+    summarizer = CountingSummarizer()
+    memory = ConversationMemory(summarizer, max_turns=2, token_budget=None)
+
+    async def next_turn():
+        memory.prefetch(conversation(4))
+        return await memory.aview(conversation(4))
+
+    messages = asyncio.run(next_turn())
+    assert summarizer.calls == ["User: question 0\nSaj: answer 0\nUser: question 1\nSaj: answer 1"]
+    assert "question 1" in messages[0].content
+    assert memory._pending == {}
+
+
+def test_a_failed_summary_keeps_the_turns_verbatim():
+    summarizer = CountingSummarizer()
+    memory = ConversationMemory(summarizer, max_turns=2, token_budget=None)
+    memory.view(conversation(3))
+    summarizer.failing = True
+    messages = memory.view(conversation(5))
+    # the cached summary of the first turn is kept, the turns it does not cover are sent as they are
+    assert messages[0].content == "Summary of the earlier conversation: User: question 0\nSaj: answer 0"
+    assert contents(messages[1:]) == [f"{kind} {i}" for i in range(1, 5) for kind in ("question", "answer")]
+
+    summarizer.failing = False
+    messages = asyncio.run(memory.aview(conversation(5)))
+    assert len(messages) == 5
+    assert summarizer.calls[-1] == "User: question 1\nSaj: answer 1\nUser: question 2\nSaj: answer 2"
+
+
+def test_the_oldest_turns_are_dropped_to_fit_the_token_budget():
+    turns = conversation(4)
+    turn_tokens = count_tokens("question 0") + count_tokens("answer 0")
+    memory = ConversationMemory(CountingSummarizer(), max_turns=4, token_budget=2 * turn_tokens)
+    assert contents(memory.view(turns)) == ["question 2", "answer 2", "question 3", "answer 3"]
+    # a turn larger than the budget is dropped too
+    assert memory.view([("long " * 1000, "answer")]) == []
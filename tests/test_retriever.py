@@ -0,0 +1,42 @@
+import pytest
+from langchain_core.documents import Document
+
+from retriever import Retriever
+
+
+def fusing_retriever(k=3, rrf_k=60, vector_weight=1.0, lexical_weight=1.0):
+    # _fuse only reads the fusion settings, so skip loading an index
+    retriever = Retriever.__new__(Retriever)
+    retriever.k, retriever.rrf_k = k, rrf_k
+    retriever.vector_weight, retriever.lexical_weight = vector_weight, lexical_weight
+    return retriever
+
+
+def documents(*contents, **metadata):
+    return [Document(page_content=content, metadata=dict(metadata)) for content in contents]
+
+
+def contents(results):
+    return [document.page_content for document in results]
+
+
+def test_chunks_found_by_both_searches_rank_first():
+    fused = fusing_retriever()._fuse(documents("a", "b", "c"), documents("c", "d", "a"))
+    assert contents(fused) == ["a", "c", "b"]
+
+
+def test_keeps_the_vector_match_with_its_similarity():
+    fused = fusing_retriever(k=2)._fuse(documents("a", similarity=0.9), documents("a", "b"))
+    assert contents(fused) == ["a", "b"]
+    assert fused[0].metadata == {"similarity": 0.9}
+
+
+def test_weights_favour_one_ranking():
+    vector, lexical = documents("a", "b"), documents("b", "a")
+    assert contents(fusing_retriever(k=2, lexical_weight=2.0)._fuse(vector, lexical)) == ["b", "a"]
+    assert contents(fusing_retriever(k=2, vector_weight=2.0)._fuse(vector, lexical)) == ["a", "b"]
+
+
+def test_rejects_unknown_backends(tmp_path):
+    with pytest.raises(ValueError, match="Unknown retriever backend"):
+        Retriever(vector_db_path=str(tmp_path / "chroma_db"), backend="faiss")